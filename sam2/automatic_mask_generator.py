@@ -5,32 +5,37 @@
 # LICENSE file in the root directory of this source tree.
 
 # Adapted from https://github.com/facebookresearch/segment-anything/blob/main/segment_anything/automatic_mask_generator.py
-from typing import Any, Dict, List, Optional, Tuple
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
 from sam2.modeling.sam2_base import SAM2Base
-from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.sam2_image_predictor import SAM2ImagePredictor, SAM2ImagePredictorOptimized
 from sam2.utils.amg import (
     area_from_rle,
     batch_iterator,
     batched_mask_to_box,
-    box_xyxy_to_xywh,
     build_all_layer_point_grids,
+    build_point_grid,
     calculate_stability_score,
     coco_encode_rle,
     generate_crop_boxes,
     is_box_near_crop_edge,
-    mask_to_rle_pytorch,
+    mask_nms,
     MaskData,
-    remove_small_regions,
+    MaskRLEs,
+    remove_small_regions_batch,
     rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
 )
+from sam2.utils.embedding_cache import ImageEmbeddingCache
 
 
 class SAM2AutomaticMaskGenerator:
@@ -53,6 +58,16 @@ class SAM2AutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         use_m2m: bool = False,
         multimask_output: bool = True,
+        embedding_cache: Optional[ImageEmbeddingCache] = None,
+        crop_batch_size: int = 4,
+        low_res_prefilter: bool = False,
+        low_res_nms_thresh: float = 0.7,
+        adaptive_sampling: bool = False,
+        adaptive_points_per_side: int = 8,
+        adaptive_uncertainty_thresh: float = 0.9,
+        adaptive_coverage_tol: float = 0.01,
+        pipeline_batches: bool = False,
+        compile_decoder: bool = False,
         **kwargs,
     ) -> None:
         """
@@ -101,6 +116,46 @@ class SAM2AutomaticMaskGenerator:
             memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
+          embedding_cache (ImageEmbeddingCache or None): If not None, the embeddings
+            of the image crops are cached, so that running again on the same image
+            skips the image encoder.
+          crop_batch_size (int): The maximum number of crops (of a crop layer, or
+            of several images with 'generate_batch') embedded together in one
+            batch by the image encoder. This bounds the memory of the image
+            encoder, which otherwise grows with the number of crops and images.
+          low_res_prefilter (bool): If True, the masks of each point batch are first
+            filtered by predicted IoU and stability score, and deduplicated by mask
+            IoU, on the low res (256x256) mask logits. Only the remaining masks are
+            upscaled to the crop resolution (where the stability score is then
+            computed and filtered again). This saves memory and upscaling time for
+            dense point grids. Ignored when use_m2m is True.
+          low_res_nms_thresh (float): The mask IoU cutoff used to remove duplicate
+            low res masks within a point batch when low_res_prefilter is True.
+          adaptive_sampling (bool): If True, the point grid of each crop is sampled
+            coarse to fine instead of all at once: a grid of adaptive_points_per_side
+            points per side is run first, then grids of twice the density, up to the
+            grid of the crop layer. Each grid only prompts the points that aren't
+            confidently covered by an already accepted mask, and the sampling stops
+            once the coverage of the crop converges. The cost then scales with the
+            complexity of the scene rather than with the grid density.
+          adaptive_points_per_side (int): The number of points along one side of the
+            first (coarsest) grid when adaptive_sampling is True.
+          adaptive_uncertainty_thresh (float): When adaptive_sampling is True, points
+            are also prompted again if all the accepted masks covering them have a
+            predicted IoU below this threshold.
+          adaptive_coverage_tol (float): When adaptive_sampling is True, the sampling
+            stops once a grid increases the covered fraction of the crop by less than
+            this.
+          pipeline_batches (bool): If True, the filtering and RLE encoding of each
+            point batch run on a worker thread (and on a separate CUDA stream on GPU),
+            while the mask decoder already runs on the next point batch. This keeps
+            the device busy during the host side work of each batch. Ignored when
+            use_m2m is True, since the refinement runs the predictor, which is not
+            thread-safe, during the postprocessing.
+          compile_decoder (bool): If True, the masks are predicted with a
+            SAM2ImagePredictorOptimized, which compiles the mask decoder (and
+            captures it in CUDA graphs on GPU) for batches of points_per_batch
+            prompts. The first batches are slow, while the decoder is compiled.
         """
 
         assert (points_per_side is None) != (
@@ -129,11 +184,18 @@ class SAM2AutomaticMaskGenerator:
                 print("Please install pycocotools")
                 raise e
 
-        self.predictor = SAM2ImagePredictor(
-            model,
+        predictor_kwargs = dict(
             max_hole_area=min_mask_region_area,
             max_sprinkle_area=min_mask_region_area,
+            embedding_cache=embedding_cache,
         )
+        if compile_decoder:
+            # The last point batch of each crop is padded to points_per_batch
+            self.predictor = SAM2ImagePredictorOptimized(
+                model, prompt_buckets=(points_per_batch,), **predictor_kwargs
+            )
+        else:
+            self.predictor = SAM2ImagePredictor(model, **predictor_kwargs)
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
@@ -148,6 +210,18 @@ class SAM2AutomaticMaskGenerator:
         self.output_mode = output_mode
         self.use_m2m = use_m2m
         self.multimask_output = multimask_output
+        if crop_batch_size < 1:
+            raise ValueError("crop_batch_size must be at least 1.")
+        self.crop_batch_size = crop_batch_size
+        self.low_res_prefilter = low_res_prefilter
+        self.low_res_nms_thresh = low_res_nms_thresh
+        self.adaptive_sampling = adaptive_sampling
+        self.adaptive_points_per_side = adaptive_points_per_side
+        self.adaptive_uncertainty_thresh = adaptive_uncertainty_thresh
+        self.adaptive_coverage_tol = adaptive_coverage_tol
+        self.pipeline_batches = pipeline_batches
+        # The prompt embeddings of the point grids (see '_grid_embeddings')
+        self._grid_embeddings_cache = {}
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2AutomaticMaskGenerator":
@@ -194,32 +268,130 @@ class SAM2AutomaticMaskGenerator:
 
         # Generate masks
         mask_data = self._generate_masks(image)
+        return self._mask_data_to_records(mask_data)
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        images: Iterable[np.ndarray],
+        images_per_batch: int = 4,
+        stream_records: bool = False,
+    ) -> Iterator[Iterable[Dict[str, Any]]]:
+        """
+        Generates masks for a stream of images, sharing the model batches across
+        images. Up to images_per_batch images are processed at once: the crops of
+        all these images are embedded together (crop_batch_size crops at a time),
+        and their point grids are decoded in batches of points_per_batch prompts
+        that span crops and images, so that the batches stay full.
+
+        The records of each image are yielded, in input order, as soon as all its
+        crops have been processed, so at most images_per_batch images (and the
+        embeddings of crop_batch_size crops) are held in memory at a time.
+
+        Arguments:
+          images (iterable(np.ndarray)): The images to generate masks for, in HWC
+            uint8 format. Can be a lazy iterator (e.g. over a dataset).
+          images_per_batch (int): The maximum number of images processed at once.
+          stream_records (bool): If True, yield an iterator over the records of
+            each image that encodes them one at a time (as 'generate_stream'),
+            e.g. to pass to an AnnotationWriter, instead of a list.
+
+        Yields:
+          list(dict(str, any)): The records for the masks of each image, in the
+            same format as returned by 'generate'.
+        """
+        image_iter = iter(images)
+        while True:
+            image_batch = list(itertools.islice(image_iter, images_per_batch))
+            if len(image_batch) == 0:
+                return
+            for mask_data in self._generate_masks_batch(image_batch):
+                if stream_records:
+                    yield self._iter_records(mask_data)
+                else:
+                    yield self._mask_data_to_records(mask_data)
+
+    @torch.no_grad()
+    def generate_stream(self, image: np.ndarray) -> Iterator[Dict[str, Any]]:
+        """
+        Generates masks for the given image like 'generate', but yields the mask
+        records one at a time, and only encodes the segmentation of each record
+        (in output_mode) when it is yielded. Together with an AnnotationWriter
+        (see sam2/utils/annotation_writer.py), the records can be written as they
+        are produced, without holding the encoded segmentations of all masks:
+
+          with AnnotationWriter("masks.jsonl") as writer:
+              for image_id, image in dataset:
+                  records = generator.generate_stream(image)
+                  writer.write(image_id, records, *image.shape[:2])
+
+        The masks are generated when the first record is requested.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+
+        Yields:
+          dict(str, any): The record of each mask, in the same format as the
+            records returned by 'generate'.
+        """
+        mask_data = self._generate_masks(image)
+        yield from self._iter_records(mask_data)
 
-        # Encode masks
+    def _mask_data_to_records(self, mask_data: MaskData) -> List[Dict[str, Any]]:
+        # Encode all masks at once where possible (this is where the RLE dicts get
+        # built from MaskRLEs)
+        rles = mask_data["rles"]
         if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [
-                coco_encode_rle(rle) for rle in mask_data["rles"]
-            ]
+            segmentations = [coco_encode_rle(rle) for rle in rles]
+        elif self.output_mode == "binary_mask" and isinstance(rles, MaskRLEs):
+            segmentations = list(rles.to_masks())
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            segmentations = [rle_to_mask(rle) for rle in rles]
         else:
-            mask_data["segmentations"] = mask_data["rles"]
-
-        # Write mask records
-        curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": mask_data["iou_preds"][idx].item(),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+            segmentations = list(rles)
+        return list(self._iter_records(mask_data, segmentations))
+
+    def _encode_segmentation(self, rle: Dict[str, Any]) -> Any:
+        if self.output_mode == "coco_rle":
+            return coco_encode_rle(rle)
+        elif self.output_mode == "binary_mask":
+            return rle_to_mask(rle)
+        return rle
 
-        return curr_anns
+    def _iter_records(
+        self, mask_data: MaskData, segmentations: Optional[List[Any]] = None
+    ) -> Iterator[Dict[str, Any]]:
+        # Segmentations that are not given are encoded one at a time
+        rles = mask_data["rles"]
+
+        # Convert each column to Python values at once
+        if isinstance(rles, MaskRLEs):
+            areas = rles.areas.tolist()
+        else:
+            areas = [area_from_rle(rle) for rle in rles]
+        boxes = np.array(mask_data["boxes"])
+        boxes[:, 2:] -= boxes[:, :2]  # XYXY to XYWH
+        crop_boxes = np.array(mask_data["crop_boxes"])
+        crop_boxes[:, 2:] -= crop_boxes[:, :2]
+        iou_preds = mask_data["iou_preds"].tolist()
+        points = mask_data["points"].tolist()
+        stability_scores = mask_data["stability_score"].tolist()
+
+        # Yield mask records
+        for idx, (box, crop_box) in enumerate(zip(boxes.tolist(), crop_boxes.tolist())):
+            if segmentations is not None:
+                segmentation = segmentations[idx]
+            else:
+                segmentation = self._encode_segmentation(rles[idx])
+            yield {
+                "segmentation": segmentation,
+                "area": areas[idx],
+                "bbox": box,
+                "predicted_iou": iou_preds[idx],
+                "point_coords": [points[idx]],
+                "stability_score": stability_scores[idx],
+                "crop_box": crop_box,
+            }
 
     def _generate_masks(self, image: np.ndarray) -> MaskData:
         orig_size = image.shape[:2]
@@ -227,14 +399,57 @@ class SAM2AutomaticMaskGenerator:
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, embedding the crops of each layer in batches
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for layer_idx in sorted(set(layer_idxs)):
+            layer_crop_boxes = [
+                box for box, idx in zip(crop_boxes, layer_idxs) if idx == layer_idx
+            ]
+            for (crop_box_batch,) in batch_iterator(
+                self.crop_batch_size, layer_crop_boxes
+            ):
+                crop_data = self._process_crops(
+                    image, crop_box_batch, layer_idx, orig_size
+                )
+                data.cat(crop_data)
+        return self._merge_crops(data, len(crop_boxes))
 
+    def _generate_masks_batch(self, images: List[np.ndarray]) -> Iterator[MaskData]:
+        # All crops of all images, embedded in batches of crop_batch_size
+        crops = []
+        for image_idx, image in enumerate(images):
+            crop_boxes, layer_idxs = generate_crop_boxes(
+                image.shape[:2], self.crop_n_layers, self.crop_overlap_ratio
+            )
+            crops.extend(
+                (image_idx, crop_box, layer_idx)
+                for crop_box, layer_idx in zip(crop_boxes, layer_idxs)
+            )
+        num_crops = np.bincount([image_idx for image_idx, _, _ in crops])
+        # The crops of an image are done once its last crop has been processed
+        image_ends = np.cumsum(num_crops)
+
+        image_data = [MaskData() for _ in images]
+        next_image_idx, num_done = 0, 0
+        for (crop_batch,) in batch_iterator(self.crop_batch_size, crops):
+            for image_idx, crop_data in self._process_crops_interleaved(
+                images, crop_batch
+            ):
+                image_data[image_idx].cat(crop_data)
+            num_done += len(crop_batch)
+            while (
+                next_image_idx < len(images) and image_ends[next_image_idx] <= num_done
+            ):
+                data = self._merge_crops(
+                    image_data[next_image_idx], num_crops[next_image_idx]
+                )
+                image_data[next_image_idx] = None
+                next_image_idx += 1
+                yield data
+
+    def _merge_crops(self, data: MaskData, num_crops: int) -> MaskData:
         # Remove duplicate masks between crops
-        if len(crop_boxes) > 1:
+        if num_crops > 1:
             # Prefer masks from smaller crops
             scores = 1 / box_area(data["crop_boxes"])
             scores = scores.to(data["boxes"].device)
@@ -248,33 +463,384 @@ class SAM2AutomaticMaskGenerator:
         data.to_numpy()
         return data
 
-    def _process_crop(
+    def _process_crops(
         self,
         image: np.ndarray,
+        crop_boxes: List[List[int]],
+        crop_layer_idx: int,
+        orig_size: Tuple[int, ...],
+    ) -> MaskData:
+        # Crop the image and calculate the embeddings of all crops at once
+        cropped_ims = [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in crop_boxes]
+        if len(cropped_ims) == 1:
+            self.predictor.set_image(cropped_ims[0])
+        else:
+            self.predictor.set_image_batch(cropped_ims)
+
+        # Generate masks for each crop against its own embedding
+        data = MaskData()
+        for img_idx, crop_box in enumerate(crop_boxes):
+            crop_data = self._process_crop(
+                cropped_ims[img_idx], crop_box, crop_layer_idx, orig_size, img_idx
+            )
+            data.cat(crop_data)
+        self.predictor.reset_predictor()
+        return data
+
+    def _process_crops_interleaved(
+        self,
+        images: List[np.ndarray],
+        crops: List[Tuple[int, List[int], int]],
+    ) -> List[Tuple[int, MaskData]]:
+        # Crop the images and calculate the embeddings of all crops at once
+        cropped_ims = [
+            images[image_idx][y0:y1, x0:x1, :]
+            for image_idx, (x0, y0, x1, y1), _ in crops
+        ]
+        self.predictor.set_image_batch(cropped_ims)
+
+        if self.adaptive_sampling:
+            # The grids of a crop depend on the masks of the previous grids, so each
+            # crop is sampled on its own
+            results = [
+                (
+                    image_idx,
+                    self._process_crop(
+                        cropped_im,
+                        crop_box,
+                        layer_idx,
+                        images[image_idx].shape[:2],
+                        img_idx=crop_idx,
+                    ),
+                )
+                for crop_idx, (
+                    cropped_im,
+                    (image_idx, crop_box, layer_idx),
+                ) in enumerate(zip(cropped_ims, crops))
+            ]
+            self.predictor.reset_predictor()
+            return results
+
+        # The point grids of all crops, decoded in batches spanning several crops
+        all_points, all_crop_inds, all_embeddings = [], [], []
+        for crop_idx, (cropped_im, (_, _, layer_idx)) in enumerate(
+            zip(cropped_ims, crops)
+        ):
+            points_scale = np.array(cropped_im.shape[:2])[None, ::-1]
+            all_points.append(self.point_grids[layer_idx] * points_scale)
+            all_crop_inds.append(np.full(len(all_points[-1]), crop_idx))
+            all_embeddings.append(self._grid_embeddings(self.point_grids[layer_idx]))
+        all_points = np.concatenate(all_points, axis=0)
+        all_crop_inds = np.concatenate(all_crop_inds, axis=0)
+        all_embeddings = torch.cat(all_embeddings, dim=0)
+
+        crop_sizes = [im.shape[:2] for im in cropped_ims]
+
+        def _predict(batch):
+            points, crop_inds, embeddings = batch
+            return self._predict_interleaved(points, crop_inds, crop_sizes, embeddings)
+
+        def _postprocess(batch, crop_predictions):
+            outputs = []
+            for crop_idx, crop_points, predictions in crop_predictions:
+                image_idx, crop_box, _ = crops[crop_idx]
+                batch_data = self._process_batch(
+                    crop_points,
+                    crop_sizes[crop_idx],
+                    crop_box,
+                    images[image_idx].shape[:2],
+                    normalize=True,
+                    img_idx=crop_idx,
+                    predictions=predictions,
+                )
+                outputs.append((crop_idx, batch_data))
+            return outputs
+
+        crop_data = [MaskData() for _ in crops]
+        batches = batch_iterator(
+            self.points_per_batch, all_points, all_crop_inds, all_embeddings
+        )
+        for outputs in self._map_batches(_predict, _postprocess, batches):
+            for crop_idx, batch_data in outputs:
+                crop_data[crop_idx].cat(batch_data)
+            del outputs
+        self.predictor.reset_predictor()
+
+        return [
+            (image_idx, self._finalize_crop(data, crop_box))
+            for data, (image_idx, crop_box, _) in zip(crop_data, crops)
+        ]
+
+    def _predict_interleaved(
+        self,
+        points: np.ndarray,
+        crop_inds: np.ndarray,
+        crop_sizes: List[Tuple[int, int]],
+        point_embeddings: Optional[torch.Tensor] = None,
+    ) -> List[Tuple[int, np.ndarray, Tuple[torch.Tensor, ...]]]:
+        """
+        Decode a batch of grid points from several crops (embedded at crop_inds in
+        the predictor) with a single mask decoder call. Returns a list over crops of
+        (crop_idx, points, (masks, iou_preds, low_res_masks)), where the masks are
+        upscaled to the size of each crop as in the predictor's '_predict'. If given,
+        point_embeddings are the precomputed prompt embeddings of the points.
+        """
+        crop_points, group, sparse_embeddings = [], [], None
+        if point_embeddings is not None:
+            sparse_embeddings = []
+        for crop_idx in np.unique(crop_inds):
+            in_crop = crop_inds == crop_idx
+            crop_points.append(points[in_crop])
+            if sparse_embeddings is not None:
+                in_crop = torch.as_tensor(in_crop, device=point_embeddings.device)
+                sparse_embeddings.append(point_embeddings[in_crop])
+            in_points = self.predictor._transforms.transform_coords(
+                torch.as_tensor(
+                    crop_points[-1], dtype=torch.float32, device=self.predictor.device
+                ),
+                normalize=True,
+                orig_hw=crop_sizes[crop_idx],
+            )
+            in_labels = torch.ones(
+                in_points.shape[0], dtype=torch.int, device=in_points.device
+            )
+            group.append((crop_idx, (in_points[:, None, :], in_labels[:, None]), None))
+        low_res_masks, iou_preds = self.predictor._predict_image_group(
+            group, self.multimask_output, sparse_embeddings
+        )
+
+        outputs = []
+        for (crop_idx, _, _), points, crop_low_res_masks, crop_iou_preds in zip(
+            group, crop_points, low_res_masks, iou_preds
+        ):
+            masks = self.predictor._transforms.postprocess_masks(
+                crop_low_res_masks,
+                crop_sizes[crop_idx] if self._upscale_predictions else None,
+            )
+            crop_low_res_masks = torch.clamp(crop_low_res_masks, -32.0, 32.0)
+            outputs.append(
+                (crop_idx, points, (masks, crop_iou_preds, crop_low_res_masks))
+            )
+        return outputs
+
+    def _process_crop(
+        self,
+        cropped_im: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        img_idx: int = 0,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
+        # The embeddings of this crop are at img_idx in the predictor
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+
+        if self.adaptive_sampling:
+            data = self._process_crop_adaptive(
+                cropped_im_size, crop_box, crop_layer_idx, orig_size, img_idx
+            )
+            return self._finalize_crop(data, crop_box)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        point_embeddings = self._grid_embeddings(self.point_grids[crop_layer_idx])
 
         # Generate masks for this crop in batches
         data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
-            )
+        for batch_data in self._map_crop_batches(
+            points_for_image,
+            cropped_im_size,
+            crop_box,
+            orig_size,
+            img_idx,
+            point_embeddings,
+        ):
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_predictor()
+        return self._finalize_crop(data, crop_box)
+
+    def _process_crop_adaptive(
+        self,
+        cropped_im_size: Tuple[int, ...],
+        crop_box: List[int],
+        crop_layer_idx: int,
+        orig_size: Tuple[int, ...],
+        img_idx: int = 0,
+    ) -> MaskData:
+        # Point grids of increasing density, ending with the grid of this layer
+        layer_grid = self.point_grids[crop_layer_idx]
+        grids, n_per_side = [], self.adaptive_points_per_side
+        while n_per_side**2 < len(layer_grid):
+            grids.append(build_point_grid(n_per_side))
+            n_per_side *= 2
+        grids.append(layer_grid)
+        points_scale = np.array(cropped_im_size)[None, ::-1]
+        grid_embeddings = [self._grid_embeddings(grid) for grid in grids]
+        grids = [grid * points_scale for grid in grids]
+        grid_starts = np.cumsum([0] + [len(grid) for grid in grids])
+
+        # The pixels of all grid points (in the original image), and the highest
+        # predicted IoU of the accepted masks covering them (-inf if uncovered)
+        pixels = np.minimum(np.concatenate(grids, axis=0), points_scale - 1)
+        pixels = pixels.astype(np.int64) + np.array(crop_box[:2])
+        confidence = np.full(len(pixels), -np.inf)
+
+        data = MaskData()
+        coverage = 0.0
+        for round_idx, grid in enumerate(grids):
+            # Only prompt the points not confidently covered by an accepted mask
+            start, end = grid_starts[round_idx], grid_starts[round_idx + 1]
+            keep = confidence[start:end] < self.adaptive_uncertainty_thresh
+            embeddings = grid_embeddings[round_idx]
+            embeddings = embeddings[torch.as_tensor(keep, device=embeddings.device)]
+            for batch_data in self._map_crop_batches(
+                grid[keep], cropped_im_size, crop_box, orig_size, img_idx, embeddings
+            ):
+                if len(batch_data["rles"]) > 0:
+                    iou_preds = batch_data["iou_preds"].float().cpu().numpy()
+                    mask_confidence = np.where(
+                        batch_data["rles"].values_at(pixels),
+                        iou_preds[:, None],
+                        -np.inf,
+                    )
+                    confidence = np.maximum(confidence, mask_confidence.max(axis=0))
+                data.cat(batch_data)
+                del batch_data
+
+            # Stop once a grid barely increases the covered fraction of the crop
+            # (measured on the points of the densest grid)
+            new_coverage = np.isfinite(confidence[-len(layer_grid) :]).mean()
+            if round_idx > 0 and new_coverage - coverage < self.adaptive_coverage_tol:
+                break
+            coverage = new_coverage
+        return data
+
+    def _map_crop_batches(
+        self,
+        points: np.ndarray,
+        cropped_im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        img_idx: int = 0,
+        point_embeddings: Optional[torch.Tensor] = None,
+    ) -> Iterator[MaskData]:
+        # Process the points of a crop in batches, yielding the data of each batch
+        def _predict(batch):
+            return self._predict_batch(
+                batch[0],
+                cropped_im_size,
+                normalize=True,
+                img_idx=img_idx,
+                point_embeddings=batch[1] if point_embeddings is not None else None,
+            )
+
+        def _postprocess(batch, predictions):
+            return self._process_batch(
+                batch[0],
+                cropped_im_size,
+                crop_box,
+                orig_size,
+                normalize=True,
+                img_idx=img_idx,
+                predictions=predictions,
+            )
 
+        if point_embeddings is not None:
+            batches = batch_iterator(self.points_per_batch, points, point_embeddings)
+        else:
+            batches = batch_iterator(self.points_per_batch, points)
+        return self._map_batches(_predict, _postprocess, batches)
+
+    def _grid_embeddings(self, point_grid: np.ndarray) -> torch.Tensor:
+        """
+        Return the prompt embeddings of the points of a normalized point grid. In the
+        input frame of the model, the grid points are the same for all crops and
+        images, so each grid is only embedded once (until the weights change).
+        """
+        key = (point_grid.tobytes(), self.predictor._prompt_encoder_key())
+        embeddings = self._grid_embeddings_cache.get(key)
+        if embeddings is None:
+            # Drop the embeddings of the previous weights
+            self._grid_embeddings_cache = {
+                k: v for k, v in self._grid_embeddings_cache.items() if k[1] == key[1]
+            }
+            in_points = torch.as_tensor(
+                point_grid * self.predictor._transforms.resolution,
+                dtype=torch.float32,
+                device=self.predictor.device,
+            )
+            in_labels = torch.ones(
+                in_points.shape[0], dtype=torch.int, device=in_points.device
+            )
+            embeddings = self.predictor._embed_points(
+                in_points[:, None, :], in_labels[:, None]
+            )
+            self._grid_embeddings_cache[key] = embeddings
+        return embeddings
+
+    def _map_batches(
+        self,
+        predict: Callable[[Any], Any],
+        postprocess: Callable[[Any, Any], Any],
+        batches: Iterable[Any],
+    ) -> Iterator[Any]:
+        """
+        Yields postprocess(batch, predict(batch)) for each batch, in order. If
+        pipeline_batches is True, postprocess runs on a worker thread while predict
+        runs on the next batch. On GPU, the worker uses its own CUDA stream, which
+        waits for the predictions of its batch with an event.
+        """
+        # With use_m2m, postprocess runs the predictor (and fills its caches) too,
+        # so it must not overlap with the predictions of the next batch
+        if not self.pipeline_batches or self.use_m2m:
+            for batch in batches:
+                yield postprocess(batch, predict(batch))
+            return
+
+        device = self.predictor.device
+        stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        # Autograd mode is thread local, so it is forwarded to the worker
+        grad_enabled = torch.is_grad_enabled()
+
+        def _postprocess(batch, predictions, ready):
+            with torch.set_grad_enabled(grad_enabled):
+                if stream is None:
+                    return postprocess(batch, predictions), None
+                with torch.cuda.stream(stream):
+                    stream.wait_event(ready)
+                    _record_stream(predictions, stream)
+                    outputs = postprocess(batch, predictions)
+                    done = torch.cuda.Event()
+                    done.record(stream)
+                return outputs, done
+
+        def _result(future):
+            outputs, done = future.result()
+            if done is not None:
+                main_stream = torch.cuda.current_stream(device)
+                main_stream.wait_event(done)
+                _record_stream(outputs, main_stream)
+            return outputs
+
+        # Keep at most one batch in postprocessing, to bound the memory used by
+        # the full resolution masks in flight
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = None
+            for batch in batches:
+                predictions = predict(batch)
+                ready = None
+                if stream is not None:
+                    ready = torch.cuda.Event()
+                    ready.record(torch.cuda.current_stream(device))
+                future = pool.submit(_postprocess, batch, predictions, ready)
+                del predictions
+                if pending is not None:
+                    yield _result(pending)
+                pending = future
+            if pending is not None:
+                yield _result(pending)
+
+    def _finalize_crop(self, data: MaskData, crop_box: List[int]) -> MaskData:
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
             data["boxes"].float(),
@@ -287,7 +853,7 @@ class SAM2AutomaticMaskGenerator:
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = torch.tensor([crop_box]).repeat(len(data["rles"]), 1)
 
         return data
 
@@ -298,25 +864,19 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = 0,
+        predictions: Optional[Tuple[torch.Tensor, ...]] = None,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
-        # Run model on this batch
+        # Run model on this batch (unless it was already decoded, e.g. with other
+        # crops or ahead of time by the batch pipeline)
+        if predictions is None:
+            predictions = self._predict_batch(points, im_size, normalize, img_idx)
         points = torch.as_tensor(
             points, dtype=torch.float32, device=self.predictor.device
         )
-        in_points = self.predictor._transforms.transform_coords(
-            points, normalize=normalize, orig_hw=im_size
-        )
-        in_labels = torch.ones(
-            in_points.shape[0], dtype=torch.int, device=in_points.device
-        )
-        masks, iou_preds, low_res_masks = self.predictor._predict(
-            in_points[:, None, :],
-            in_labels[:, None],
-            multimask_output=self.multimask_output,
-            return_logits=True,
-        )
+        masks, iou_preds, low_res_masks = predictions
 
         # Serialize predictions and store in MaskData
         data = MaskData(
@@ -328,6 +888,10 @@ class SAM2AutomaticMaskGenerator:
         del masks
 
         if not self.use_m2m:
+            if self.low_res_prefilter:
+                # Filter on the low res masks first, and only upscale the rest
+                self._low_res_prefilter(data, im_size)
+
             # Filter by predicted IoU
             if self.pred_iou_thresh > 0.0:
                 keep_mask = data["iou_preds"] > self.pred_iou_thresh
@@ -349,7 +913,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                self.points_per_batch,
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -378,14 +946,89 @@ class SAM2AutomaticMaskGenerator:
 
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        data["rles"] = MaskRLEs.from_masks(data["masks"])
         del data["masks"]
 
         return data
 
+    def _predict_batch(
+        self,
+        points: np.ndarray,
+        im_size: Tuple[int, ...],
+        normalize=False,
+        img_idx: int = 0,
+        point_embeddings: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, ...]:
+        if point_embeddings is not None:
+            # The points were already embedded by the prompt encoder
+            return self.predictor._predict(
+                None,
+                None,
+                multimask_output=self.multimask_output,
+                return_logits=True,
+                img_idx=img_idx,
+                upscale_masks=self._upscale_predictions,
+                sparse_embeddings=point_embeddings,
+            )
+
+        points = torch.as_tensor(
+            points, dtype=torch.float32, device=self.predictor.device
+        )
+        in_points = self.predictor._transforms.transform_coords(
+            points, normalize=normalize, orig_hw=im_size
+        )
+        in_labels = torch.ones(
+            in_points.shape[0], dtype=torch.int, device=in_points.device
+        )
+        return self.predictor._predict(
+            in_points[:, None, :],
+            in_labels[:, None],
+            multimask_output=self.multimask_output,
+            return_logits=True,
+            img_idx=img_idx,
+            upscale_masks=self._upscale_predictions,
+        )
+
+    @property
+    def _upscale_predictions(self) -> bool:
+        # The initial masks are replaced by the refined ones with m2m, so they
+        # never need to be upscaled in that case
+        return not (self.low_res_prefilter or self.use_m2m)
+
+    def _low_res_prefilter(self, data: MaskData, im_size: Tuple[int, ...]) -> None:
+        # Filter by predicted IoU and by stability score on the low res masks
+        if self.pred_iou_thresh > 0.0:
+            data.filter(data["iou_preds"] > self.pred_iou_thresh)
+        if self.stability_score_thresh > 0.0:
+            stability_score = calculate_stability_score(
+                data["masks"], self.mask_threshold, self.stability_score_offset
+            )
+            data.filter(stability_score >= self.stability_score_thresh)
+
+        # Remove the duplicates by mask IoU of the low res masks
+        keep_by_nms = mask_nms(
+            data["masks"] > self.mask_threshold,
+            data["iou_preds"],
+            iou_threshold=self.low_res_nms_thresh,
+        )
+        data.filter(keep_by_nms)
+
+        # Upscale the remaining masks to the crop size
+        masks = data["masks"]
+        if len(masks) == 0:
+            data["masks"] = masks.new_zeros((0, *im_size))
+        else:
+            data["masks"] = F.interpolate(
+                masks[:, None], im_size, mode="bilinear", align_corners=False
+            )[:, 0]
+
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        batch_size: int = 64,
+        device: Optional[torch.device] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
@@ -393,48 +1036,60 @@ class SAM2AutomaticMaskGenerator:
 
         Edits mask_data in place.
 
-        Requires open-cv as a dependency.
+        The masks are processed batch_size at a time with the connected components
+        op (see 'get_connected_components'), on the given device (e.g. the device
+        of the predictor, 'self.predictor.device'), or on the CPU, where the masks
+        are decoded, if device is None.
         """
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
+        rles = mask_data["rles"]
+        if not isinstance(rles, MaskRLEs):
+            rles = MaskRLEs.from_list(rles, rles[0]["size"])
+        h, w = rles.size
+        masks = torch.from_numpy(rles.to_masks(np.empty((len(rles), h, w), bool)))
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+        # Filter small disconnected regions and holes of all masks in batches
+        device = masks.device if device is None else torch.device(device)
+        new_masks, changed = [], []
+        for (batch_masks,) in batch_iterator(batch_size, masks):
+            batch_masks, batch_changed = remove_small_regions_batch(
+                batch_masks.to(device), min_area
+            )
+            new_masks.append(batch_masks.cpu())
+            changed.append(batch_changed.cpu())
+        masks = torch.cat(new_masks, dim=0)
+        changed = torch.cat(changed, dim=0)
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = (~changed).float()
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
         boxes = batched_mask_to_box(masks)
         keep_by_nms = batched_nms(
             boxes.float(),
-            torch.as_tensor(scores),
+            scores,
             torch.zeros_like(boxes[:, 0]),  # categories
             iou_threshold=nms_thresh,
         )
 
         # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        changed_inds = keep_by_nms[changed[keep_by_nms]].numpy()
+        if len(changed_inds) > 0:
+            rles = rles.replace(changed_inds, MaskRLEs.from_masks(masks[changed_inds]))
+            # update res directly
+            mask_data["boxes"][changed_inds] = boxes[changed_inds]
+        if not isinstance(mask_data["rles"], MaskRLEs):
+            rles = list(rles)
+        mask_data["rles"] = rles
         mask_data.filter(keep_by_nms)
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=0
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,8 +1102,22 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
         masks = torch.cat(new_masks, dim=0)
         return masks, torch.cat(new_iou_preds, dim=0)
+
+
+def _record_stream(obj: Any, stream: "torch.cuda.Stream") -> None:
+    # Mark the CUDA tensors in (nested) outputs as used on `stream`, so that the
+    # caching allocator doesn't reuse their memory before the stream is done
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, MaskData):
+        _record_stream([v for _, v in obj.items()], stream)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _record_stream(item, stream)
@@ -4,7 +4,6 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-import os
 import time
 
 import numpy as np
@@ -12,6 +11,7 @@ import torch
 from tqdm import tqdm
 
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.frame_index import list_frames
 
 # Only cuda supported
 assert torch.cuda.is_available()
@@ -35,13 +35,8 @@ predictor = build_sam2_video_predictor(
 
 # Initialize with video
 video_dir = "notebooks/videos/bedroom"
-# scan all the JPEG frame names in this directory
-frame_names = [
-    p
-    for p in os.listdir(video_dir)
-    if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG"]
-]
-frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+# scan all the frame names in this directory
+frame_names = list_frames(video_dir)
 inference_state = predictor.init_state(video_path=video_dir)
 
 
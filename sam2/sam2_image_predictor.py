@@ -4,18 +4,33 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import itertools
 import logging
+import os
+import threading
+from collections import defaultdict
+from functools import partial
 
-from typing import List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 from PIL.Image import Image
 
 from sam2.modeling.sam2_base import SAM2Base
+from sam2.utils.amg import batched_mask_to_box, MaskRLEs
+from sam2.utils.embedding_cache import ImageEmbeddingCache
+from sam2.utils.embedding_io import (
+    embedding_to_torch,
+    load_image_embedding,
+    save_image_embedding,
+)
 
 from sam2.utils.transforms import SAM2Transforms
 
+# The torch dtypes of the numpy dtypes of the prompts (see '_prep_prompts')
+_NUMPY_TO_TORCH_DTYPE = {np.float32: torch.float32, np.int32: torch.int32}
+
 
 class SAM2ImagePredictor:
     def __init__(
@@ -24,6 +39,7 @@ class SAM2ImagePredictor:
         mask_threshold=0.0,
         max_hole_area=0.0,
         max_sprinkle_area=0.0,
+        embedding_cache: Optional[ImageEmbeddingCache] = None,
         **kwargs,
     ) -> None:
         """
@@ -38,6 +54,9 @@ class SAM2ImagePredictor:
             the maximum area of max_hole_area in low_res_masks.
           max_sprinkle_area (int): If max_sprinkle_area > 0, we remove small sprinkles up to
             the maximum area of max_sprinkle_area in low_res_masks.
+          embedding_cache (ImageEmbeddingCache or None): If not None, the image
+            embeddings computed by 'set_image' are cached, and setting an image
+            already in the cache skips the image encoder.
         """
         super().__init__()
         self.model = sam_model
@@ -54,9 +73,12 @@ class SAM2ImagePredictor:
         self._orig_hw = None
         # Whether the predictor is set for single image or a batch of images
         self._is_batch = False
+        # The dense positional encoding of the image embeddings (see '_get_dense_pe')
+        self._dense_pe = None
 
         # Predictor config
         self.mask_threshold = mask_threshold
+        self.embedding_cache = embedding_cache
 
         # Spatial dim for backbone feature maps
         self._bb_feat_sizes = [
@@ -107,6 +129,18 @@ class SAM2ImagePredictor:
         else:
             raise NotImplementedError("Image format not supported")
 
+        cache_key = None
+        if self.embedding_cache is not None:
+            cache_key = self.embedding_cache.key(
+                np.asarray(image), self.model.image_size
+            )
+            features = self.embedding_cache.get(cache_key, device=self.device)
+            if features is not None:
+                logging.info("Using cached image embeddings.")
+                self._features = features
+                self._is_image_set = True
+                return
+
         input_image = self._transforms(image)
         input_image = input_image[None, ...].to(self.device)
 
@@ -114,24 +148,17 @@ class SAM2ImagePredictor:
             len(input_image.shape) == 4 and input_image.shape[1] == 3
         ), f"input_image must be of size 1x3xHxW, got {input_image.shape}"
         logging.info("Computing image embeddings for the provided image...")
-        backbone_out = self.model.forward_image(input_image)
-        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
-        # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
-        if self.model.directly_add_no_mem_embed:
-            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
-
-        feats = [
-            feat.permute(1, 2, 0).view(1, -1, *feat_size)
-            for feat, feat_size in zip(vision_feats[::-1], self._bb_feat_sizes[::-1])
-        ][::-1]
-        self._features = {"image_embed": feats[-1], "high_res_feats": feats[:-1]}
+        self._features = self._compute_features(input_image)
         self._is_image_set = True
+        if cache_key is not None:
+            self.embedding_cache.put(cache_key, self._features)
         logging.info("Image embeddings computed.")
 
     @torch.no_grad()
     def set_image_batch(
         self,
         image_list: List[Union[np.ndarray]],
+        num_workers: int = 0,
     ) -> None:
         """
         Calculates the image embeddings for the provided image batch, allowing
@@ -140,6 +167,8 @@ class SAM2ImagePredictor:
         Arguments:
           image_list (List[np.ndarray]): The input images to embed in RGB format. The image should be in HWC format if np.ndarray
           with pixel values in [0, 255].
+          num_workers (int): If > 0, the number of worker threads used to upload the
+            images to the device during preprocessing.
         """
         self.reset_predictor()
         assert isinstance(image_list, list)
@@ -149,14 +178,60 @@ class SAM2ImagePredictor:
                 image, np.ndarray
             ), "Images are expected to be an np.ndarray in RGB format, and of shape  HWC"
             self._orig_hw.append(image.shape[:2])
-        # Transform the image to the form expected by the model
-        img_batch = self._transforms.forward_batch(image_list)
-        img_batch = img_batch.to(self.device)
+
+        # Only embed the images that are not in the embedding cache
+        cache_keys = [None] * len(image_list)
+        cached = [None] * len(image_list)
+        if self.embedding_cache is not None:
+            cache_keys = [
+                self.embedding_cache.key(image, self.model.image_size)
+                for image in image_list
+            ]
+            cached = [
+                self.embedding_cache.get(key, device=self.device) for key in cache_keys
+            ]
+        missing = [i for i, features in enumerate(cached) if features is None]
+
+        features = None
+        if len(missing) > 0:
+            # Transform the image to the form expected by the model
+            img_batch = self._transforms.forward_batch(
+                [image_list[i] for i in missing],
+                device=self.device,
+                num_workers=num_workers,
+            )
+            assert (
+                len(img_batch.shape) == 4 and img_batch.shape[1] == 3
+            ), f"img_batch must be of size Bx3xHxW, got {img_batch.shape}"
+            logging.info("Computing image embeddings for the provided images...")
+            features = self._compute_features(img_batch)
+            for j, i in enumerate(missing):
+                if cache_keys[i] is not None:
+                    # clone so that the cache doesn't hold on to the whole batch
+                    cached[i] = {
+                        "image_embed": features["image_embed"][j : j + 1].clone(),
+                        "high_res_feats": [
+                            feat[j : j + 1].clone()
+                            for feat in features["high_res_feats"]
+                        ],
+                    }
+                    self.embedding_cache.put(cache_keys[i], cached[i])
+            logging.info("Image embeddings computed.")
+        if len(missing) < len(image_list):
+            features = {
+                "image_embed": torch.cat([f["image_embed"] for f in cached], dim=0),
+                "high_res_feats": [
+                    torch.cat(feats, dim=0)
+                    for feats in zip(*[f["high_res_feats"] for f in cached])
+                ],
+            }
+        self._features = features
+        self._is_image_set = True
+        self._is_batch = True
+
+    def _compute_features(self, img_batch: torch.Tensor) -> dict:
+        """Run the image encoder on a preprocessed Bx3xHxW batch."""
         batch_size = img_batch.shape[0]
-        assert (
-            len(img_batch.shape) == 4 and img_batch.shape[1] == 3
-        ), f"img_batch must be of size Bx3xHxW, got {img_batch.shape}"
-        logging.info("Computing image embeddings for the provided images...")
         backbone_out = self.model.forward_image(img_batch)
         _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
         # Add no_mem_embed, which is added to the lowest rest feat. map during training on videos
@@ -167,10 +242,7 @@ class SAM2ImagePredictor:
             feat.permute(1, 2, 0).view(batch_size, -1, *feat_size)
             for feat, feat_size in zip(vision_feats[::-1], self._bb_feat_sizes[::-1])
         ][::-1]
-        self._features = {"image_embed": feats[-1], "high_res_feats": feats[:-1]}
-        self._is_image_set = True
-        self._is_batch = True
-        logging.info("Image embeddings computed.")
+        return {"image_embed": feats[-1], "high_res_feats": feats[:-1]}
 
     def predict_batch(
         self,
@@ -184,6 +256,10 @@ class SAM2ImagePredictor:
     ) -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
         """This function is very similar to predict(...), however it is used for batched mode, when the model is expected to generate predictions on multiple images.
         It returns a tuple of lists of masks, ious, and low_res_masks_logits.
+
+        The prompts of all images with the same number of points (and boxes) are decoded
+        together in a single prompt encoder and mask decoder call, and all outputs are
+        copied to the host at once.
         """
         assert self._is_batch, "This function should only be used when in batched mode"
         if not self._is_image_set:
@@ -191,11 +267,11 @@ class SAM2ImagePredictor:
                 "An image must be set with .set_image_batch(...) before mask prediction."
             )
         num_images = len(self._features["image_embed"])
-        all_masks = []
-        all_ious = []
-        all_low_res_masks = []
+        # Transform the input prompts of each image and group the images by the number
+        # of input points (including box corners) and whether they have a mask input,
+        # so that each group is decoded by a single prompt encoder and mask decoder call
+        groups = defaultdict(list)
         for img_idx in range(num_images):
-            # Transform input prompts
             point_coords = (
                 point_coords_batch[img_idx] if point_coords_batch is not None else None
             )
@@ -214,26 +290,296 @@ class SAM2ImagePredictor:
                 normalize_coords,
                 img_idx=img_idx,
             )
-            masks, iou_predictions, low_res_masks = self._predict(
-                unnorm_coords,
-                labels,
-                unnorm_box,
-                mask_input,
-                multimask_output,
-                return_logits=return_logits,
-                img_idx=img_idx,
+            concat_points = self._concat_points_and_boxes(
+                unnorm_coords, labels, unnorm_box
+            )
+            num_points = None if concat_points is None else concat_points[0].shape[1]
+            groups[(num_points, mask_input is not None)].append(
+                (img_idx, concat_points, mask_input)
             )
-            masks_np = masks.squeeze(0).float().detach().cpu().numpy()
-            iou_predictions_np = (
-                iou_predictions.squeeze(0).float().detach().cpu().numpy()
+
+        all_low_res_masks = [None] * num_images
+        all_ious = [None] * num_images
+        for group in groups.values():
+            low_res_masks, iou_predictions = self._predict_image_group(
+                group, multimask_output
             )
-            low_res_masks_np = low_res_masks.squeeze(0).float().detach().cpu().numpy()
-            all_masks.append(masks_np)
-            all_ious.append(iou_predictions_np)
-            all_low_res_masks.append(low_res_masks_np)
+            for img_idx, img_low_res_masks, img_ious in zip(
+                [img_idx for img_idx, _, _ in group], low_res_masks, iou_predictions
+            ):
+                all_low_res_masks[img_idx] = img_low_res_masks
+                all_ious[img_idx] = img_ious
 
+        # Upscale the masks to the original image resolution (once per image size)
+        all_masks = [None] * num_images
+        img_inds_per_hw = defaultdict(list)
+        for img_idx in range(num_images):
+            img_inds_per_hw[tuple(self._orig_hw[img_idx])].append(img_idx)
+        for orig_hw, img_inds in img_inds_per_hw.items():
+            masks = self._transforms.postprocess_masks(
+                torch.cat([all_low_res_masks[i] for i in img_inds], dim=0), orig_hw
+            )
+            num_objects = [all_low_res_masks[i].shape[0] for i in img_inds]
+            for img_idx, img_masks in zip(img_inds, masks.split(num_objects)):
+                if not return_logits:
+                    img_masks = img_masks > self.mask_threshold
+                all_masks[img_idx] = img_masks
+        all_low_res_masks = [
+            torch.clamp(low_res_masks, -32.0, 32.0)
+            for low_res_masks in all_low_res_masks
+        ]
+
+        # Copy all outputs to the host at once
+        outputs = self._to_numpy(
+            [m.squeeze(0) for m in all_masks]
+            + [iou.squeeze(0) for iou in all_ious]
+            + [m.squeeze(0) for m in all_low_res_masks]
+        )
+        all_masks = outputs[:num_images]
+        all_ious = outputs[num_images : 2 * num_images]
+        all_low_res_masks = outputs[2 * num_images :]
         return all_masks, all_ious, all_low_res_masks
 
+    @torch.no_grad()
+    def _predict_image_group(self, group, multimask_output, sparse_embeddings=None):
+        """
+        Run the prompt encoder and the mask decoder once for a group of images from
+        the batch with the same prompt shapes. `group` is a list over images of
+        (img_idx, concat_points, mask_input) tuples, where concat_points are the
+        transformed points and boxes of an image (see `_concat_points_and_boxes`).
+        If sparse_embeddings is not None, it is a list over images of the precomputed
+        embeddings of their points (see `_embed_points`), used instead of running the
+        prompt encoder on them.
+        Returns lists over the images of the low res mask logits and IoU predictions.
+        """
+        # Number of prompted objects in each image
+        num_objects = []
+        for _, concat_points, mask_input in group:
+            if concat_points is not None:
+                num_objects.append(concat_points[0].shape[0])
+            elif mask_input is not None:
+                num_objects.append(mask_input.shape[0])
+            else:
+                num_objects.append(1)
+        img_inds = torch.repeat_interleave(
+            torch.tensor([img_idx for img_idx, _, _ in group], device=self.device),
+            torch.tensor(num_objects, device=self.device),
+        )
+
+        concat_points = None
+        if group[0][1] is not None:
+            concat_points = (
+                torch.cat([p[0] for _, p, _ in group], dim=0),
+                torch.cat([p[1] for _, p, _ in group], dim=0),
+            )
+        mask_input = None
+        if group[0][2] is not None:
+            mask_input = torch.cat(
+                [m.expand(n, -1, -1, -1) for (_, _, m), n in zip(group, num_objects)],
+                dim=0,
+            )
+        if sparse_embeddings is not None:
+            sparse_embeddings = torch.cat(sparse_embeddings, dim=0)
+            dense_embeddings = self._embed_dense(mask_input, len(sparse_embeddings))
+        else:
+            sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
+                points=concat_points,
+                boxes=None,
+                masks=mask_input,
+            )
+        if concat_points is None and mask_input is None:
+            # the prompt embeddings are the same for all images without prompts
+            sparse_embeddings = sparse_embeddings.expand(len(img_inds), -1, -1)
+            dense_embeddings = dense_embeddings.expand(len(img_inds), -1, -1, -1)
+
+        # Gather the image features of each object and decode all objects at once
+        high_res_features = [
+            feat_level[img_inds] for feat_level in self._features["high_res_feats"]
+        ]
+        low_res_masks, iou_predictions = self._run_mask_decoder(
+            self._features["image_embed"][img_inds],
+            high_res_features,
+            sparse_embeddings,
+            dense_embeddings,
+            multimask_output,
+            repeat_image=False,
+        )
+        return low_res_masks.split(num_objects), iou_predictions.split(num_objects)
+
+    @staticmethod
+    def _to_numpy(tensors: List[torch.Tensor]) -> List[np.ndarray]:
+        """
+        Copy a list of tensors to the host as float32 numpy arrays, with a single
+        device-to-host transfer.
+        """
+        if len(tensors) == 0:
+            return []
+        flat = torch.cat([t.detach().float().flatten() for t in tensors])
+        flat = flat.cpu().numpy()
+        sizes = np.cumsum([t.numel() for t in tensors])[:-1]
+        return [a.reshape(t.shape) for a, t in zip(np.split(flat, sizes), tensors)]
+
+    @torch.no_grad()
+    def predict_boxes(
+        self,
+        samples: Iterable[Tuple[np.ndarray, np.ndarray]],
+        images_per_batch: int = 8,
+        boxes_per_batch: int = 64,
+        output_mode: str = "rle",
+        multimask_output: bool = False,
+        normalize_coords: bool = True,
+        num_workers: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Predict one mask per box prompt for a stream of (image, boxes) pairs, e.g. the
+        detections of an object detector. The images are embedded images_per_batch
+        at a time (with 'set_image_batch', so the predictor is left set to the last
+        batch of images), and the boxes of all these images are decoded together, in
+        batches of up to boxes_per_batch boxes that span images. The masks are
+        upscaled, thresholded and encoded on the device, and only compact outputs are
+        copied to the host. boxes_per_batch also bounds the number of full resolution
+        masks held on the device at a time.
+
+        Arguments:
+          samples (iterable(tuple(np.ndarray, np.ndarray))): The (image, boxes)
+            pairs, with images in HWC uint8 RGB format and boxes as Nx4 arrays in
+            XYXY format. Can be a lazy iterator (e.g. over a dataset).
+          images_per_batch (int): The number of images embedded at once.
+          boxes_per_batch (int): The maximum number of boxes decoded at once.
+          output_mode (str): 'rle' to return the masks at the original image
+            resolution as uncompressed RLEs, or 'low_res_logits' to return the low
+            resolution mask logits instead.
+          multimask_output (bool): If true, the model predicts three masks per box,
+            and the one with the highest predicted IoU is returned.
+          normalize_coords (bool): If true, the boxes are in pixels of the image,
+            otherwise they are already normalized to [0, 1].
+          num_workers (int): If > 0, the number of worker threads used to upload the
+            images to the device (see 'set_image_batch').
+
+        Yields:
+          dict(str, any): The outputs for each pair, in input order, with keys:
+            rles (MaskRLEs): With output_mode='rle', the N masks of the image (see
+              'MaskRLEs.to_list' and 'MaskRLEs.to_masks' to decode them).
+            low_res_masks (np.ndarray): With output_mode='low_res_logits', an array
+              of shape NxHxW of the mask logits, where H=W=256.
+            boxes (np.ndarray): The Nx4 boxes around the masks at the original image
+              resolution, in XYXY format.
+            iou_predictions (np.ndarray): The N predicted mask IoUs.
+        """
+        if output_mode not in ["rle", "low_res_logits"]:
+            raise ValueError(f"Unknown output_mode {output_mode}.")
+        sample_iter = iter(samples)
+        while True:
+            batch = list(itertools.islice(sample_iter, images_per_batch))
+            if len(batch) == 0:
+                return
+            self.set_image_batch([image for image, _ in batch], num_workers)
+            yield from self._predict_boxes_batch(
+                [boxes for _, boxes in batch],
+                boxes_per_batch,
+                output_mode,
+                multimask_output,
+                normalize_coords,
+            )
+
+    def _predict_boxes_batch(
+        self,
+        boxes_list: List[np.ndarray],
+        boxes_per_batch: int,
+        output_mode: str,
+        multimask_output: bool,
+        normalize_coords: bool,
+    ) -> List[Dict[str, Any]]:
+        # Transform the boxes of each image to the input frame, as 2 corner points
+        box_coords = []
+        for img_idx, boxes in enumerate(boxes_list):
+            boxes = torch.as_tensor(boxes, dtype=torch.float, device=self.device)
+            box_coords.append(
+                self._transforms.transform_boxes(
+                    boxes.reshape(-1, 4),
+                    normalize=normalize_coords,
+                    orig_hw=self._orig_hw[img_idx],
+                )
+            )
+        num_boxes = [len(coords) for coords in box_coords]
+        box_offsets = np.concatenate([[0], np.cumsum(num_boxes)])
+        all_coords = torch.cat(box_coords, dim=0)
+        all_labels = torch.tensor([[2, 3]], dtype=torch.int, device=self.device)
+        all_labels = all_labels.repeat(len(all_coords), 1)
+
+        # Decode the boxes of all images boxes_per_batch at a time, as groups of the
+        # consecutive boxes of each image (see '_predict_image_group')
+        outputs = [defaultdict(list) for _ in boxes_list]
+        for start in range(0, len(all_coords), boxes_per_batch):
+            end = min(start + boxes_per_batch, len(all_coords))
+            first_img = np.searchsorted(box_offsets, start, side="right") - 1
+            last_img = np.searchsorted(box_offsets, end, side="left")
+            group = []
+            for img_idx in range(first_img, last_img):
+                img_start = max(start, box_offsets[img_idx])
+                img_end = min(end, box_offsets[img_idx + 1])
+                if img_end > img_start:
+                    points = (
+                        all_coords[img_start:img_end],
+                        all_labels[img_start:img_end],
+                    )
+                    group.append((img_idx, points, None))
+            low_res_masks, iou_predictions = self._predict_image_group(
+                group, multimask_output
+            )
+
+            batch_outputs = []
+            for (img_idx, _, _), img_low_res_masks, img_ious in zip(
+                group, low_res_masks, iou_predictions
+            ):
+                if multimask_output:
+                    # Keep the mask with the highest predicted IoU for each box
+                    best = img_ious.argmax(dim=1)
+                    inds = torch.arange(len(best), device=best.device)
+                    img_low_res_masks = img_low_res_masks[inds, best, None]
+                    img_ious = img_ious[inds, best, None]
+                masks = self._transforms.postprocess_masks(
+                    img_low_res_masks, self._orig_hw[img_idx]
+                )
+                masks = masks[:, 0] > self.mask_threshold
+                if output_mode == "rle":
+                    outputs[img_idx]["rles"].append(MaskRLEs.from_masks(masks))
+                else:
+                    img_low_res_masks = torch.clamp(img_low_res_masks, -32.0, 32.0)
+                    batch_outputs.append(
+                        (img_idx, "low_res_masks", img_low_res_masks[:, 0])
+                    )
+                batch_outputs.append((img_idx, "boxes", batched_mask_to_box(masks)))
+                batch_outputs.append((img_idx, "iou_predictions", img_ious[:, 0]))
+
+            # Copy the compact outputs of the batch to the host at once
+            arrays = self._to_numpy([t for _, _, t in batch_outputs])
+            for (img_idx, key, _), array in zip(batch_outputs, arrays):
+                outputs[img_idx][key].append(array)
+
+        # Concatenate the outputs of each image across batches
+        low_res_size = self.model.sam_prompt_encoder.mask_input_size
+        results = []
+        for img_idx, img_outputs in enumerate(outputs):
+            result = {}
+            if output_mode == "rle":
+                rles = img_outputs["rles"]
+                if len(rles) == 0:
+                    rles = [MaskRLEs(np.zeros(0), np.zeros(1), self._orig_hw[img_idx])]
+                result["rles"] = rles[0]
+                for other in rles[1:]:
+                    result["rles"] = result["rles"].cat(other)
+            else:
+                result["low_res_masks"] = np.concatenate(
+                    img_outputs["low_res_masks"] or [np.zeros((0, *low_res_size))]
+                )
+            result["boxes"] = np.concatenate(img_outputs["boxes"] or [np.zeros((0, 4))])
+            result["iou_predictions"] = np.concatenate(
+                img_outputs["iou_predictions"] or [np.zeros(0)]
+            )
+            results.append(result)
+        return results
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
@@ -268,6 +614,9 @@ class SAM2ImagePredictor:
             instead of a binary mask.
           normalize_coords (bool): If true, the point coordinates will be normalized to the range [0,1] and point_coords is expected to be wrt. image dimensions.
 
+        The prompts can also be given as torch tensors (e.g. already on the device),
+        which are transformed on their device instead of being uploaded.
+
         Returns:
           (np.ndarray): The output masks in CxHxW format, where C is the
             number of masks, and (H, W) is the original image size.
@@ -297,42 +646,98 @@ class SAM2ImagePredictor:
             return_logits=return_logits,
         )
 
-        masks_np = masks.squeeze(0).float().detach().cpu().numpy()
-        iou_predictions_np = iou_predictions.squeeze(0).float().detach().cpu().numpy()
-        low_res_masks_np = low_res_masks.squeeze(0).float().detach().cpu().numpy()
+        # Copy all outputs to the host at once
+        masks_np, iou_predictions_np, low_res_masks_np = self._to_numpy(
+            [masks.squeeze(0), iou_predictions.squeeze(0), low_res_masks.squeeze(0)]
+        )
         return masks_np, iou_predictions_np, low_res_masks_np
 
     def _prep_prompts(
         self, point_coords, point_labels, box, mask_logits, normalize_coords, img_idx=-1
     ):
-
-        unnorm_coords, labels, unnorm_box, mask_input = None, None, None, None
+        """
+        Transform the prompts to the input frame of the model, as tensors on the
+        device. Prompts given as numpy arrays (or lists) are transformed on the host
+        and uploaded together with a single host to device copy (see
+        '_upload_prompts'). Prompts given as torch tensors, e.g. already on the
+        device, are transformed where they are, with a single multiply.
+        """
         if point_coords is not None:
             assert (
                 point_labels is not None
             ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = torch.as_tensor(
-                point_coords, dtype=torch.float, device=self.device
-            )
-            unnorm_coords = self._transforms.transform_coords(
-                point_coords, normalize=normalize_coords, orig_hw=self._orig_hw[img_idx]
-            )
-            labels = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
-            if len(unnorm_coords.shape) == 2:
-                unnorm_coords, labels = unnorm_coords[None, ...], labels[None, ...]
-        if box is not None:
-            box = torch.as_tensor(box, dtype=torch.float, device=self.device)
-            unnorm_box = self._transforms.transform_boxes(
-                box, normalize=normalize_coords, orig_hw=self._orig_hw[img_idx]
-            )  # Bx2x2
-        if mask_logits is not None:
-            mask_input = torch.as_tensor(
-                mask_logits, dtype=torch.float, device=self.device
-            )
-            if len(mask_input.shape) == 3:
-                mask_input = mask_input[None, :, :, :]
+        prompts = {
+            "coords": (point_coords, np.float32),
+            "labels": (point_labels, np.int32),
+            "box": (box, np.float32),
+            "mask": (mask_logits, np.float32),
+        }
+        coords_scale = self._transforms.coords_scale(
+            normalize_coords, self._orig_hw[img_idx]
+        )
+        host_prompts, tensors = {}, {}
+        for name, (value, dtype) in prompts.items():
+            if value is None:
+                tensors[name] = None
+                continue
+            is_tensor = isinstance(value, torch.Tensor)
+            if is_tensor:
+                value = value.to(self.device, _NUMPY_TO_TORCH_DTYPE[dtype])
+            else:
+                value = np.asarray(value, dtype=dtype)
+            if name == "box":
+                value = value.reshape(-1, 2, 2)
+            if is_tensor and name in ["coords", "box"]:
+                value = self._transforms.transform_coords(
+                    value, normalize=normalize_coords, orig_hw=self._orig_hw[img_idx]
+                )
+            elif name in ["coords", "box"]:
+                # Normalize and un-normalize the coordinates in one multiply
+                value = value * np.array(coords_scale, dtype=np.float32)
+            if is_tensor:
+                tensors[name] = value
+            else:
+                host_prompts[name] = value
+        tensors.update(self._upload_prompts(host_prompts))
+
+        unnorm_coords, labels = tensors["coords"], tensors["labels"]
+        if unnorm_coords is not None and len(unnorm_coords.shape) == 2:
+            unnorm_coords, labels = unnorm_coords[None, ...], labels[None, ...]
+        unnorm_box = tensors["box"]  # Bx2x2
+        mask_input = tensors["mask"]
+        if mask_input is not None and len(mask_input.shape) == 3:
+            mask_input = mask_input[None, :, :, :]
         return mask_input, unnorm_coords, labels, unnorm_box
 
+    def _upload_prompts(self, arrays: dict) -> dict:
+        """
+        Copy a dict of numpy arrays (with 4-byte dtypes) to the device at once: the
+        arrays are packed into one (pinned, on CUDA) byte buffer, uploaded with a
+        single copy, and returned as views of the uploaded buffer.
+        """
+        if len(arrays) == 0:
+            return {}
+        arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+        buffer = torch.empty(
+            sum(a.nbytes for a in arrays.values()),
+            dtype=torch.uint8,
+            pin_memory=self.device.type == "cuda",
+        )
+        buffer_np = buffer.numpy()
+        offsets = {}
+        offset = 0
+        for name, a in arrays.items():
+            buffer_np[offset : offset + a.nbytes] = a.reshape(-1).view(np.uint8)
+            offsets[name] = offset
+            offset += a.nbytes
+        buffer = buffer.to(self.device, non_blocking=True)
+        return {
+            name: buffer[offsets[name] : offsets[name] + a.nbytes]
+            .view(_NUMPY_TO_TORCH_DTYPE[a.dtype.type])
+            .view(a.shape)
+            for name, a in arrays.items()
+        }
+
     @torch.no_grad()
     def _predict(
         self,
@@ -343,6 +748,8 @@ class SAM2ImagePredictor:
         multimask_output: bool = True,
         return_logits: bool = False,
         img_idx: int = -1,
+        upscale_masks: bool = True,
+        sparse_embeddings: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -369,6 +776,11 @@ class SAM2ImagePredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          upscale_masks (bool): If false, the output masks are post-processed
+            but kept at the low resolution of the model (H=W=256).
+          sparse_embeddings (torch.Tensor or None): The BxNxC embeddings of the point
+            prompts, precomputed with '_embed_points'. If given, they are used instead
+            of embedding point_coords and point_labels (and boxes must be None).
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
@@ -384,52 +796,43 @@ class SAM2ImagePredictor:
                 "An image must be set with .set_image(...) before mask prediction."
             )
 
-        if point_coords is not None:
-            concat_points = (point_coords, point_labels)
-        else:
-            concat_points = None
-
         # Embed prompts
-        if boxes is not None:
-            box_coords = boxes.reshape(-1, 2, 2)
-            box_labels = torch.tensor([[2, 3]], dtype=torch.int, device=boxes.device)
-            box_labels = box_labels.repeat(boxes.size(0), 1)
-            # we merge "boxes" and "points" into a single "concat_points" input (where
-            # boxes are added at the beginning) to sam_prompt_encoder
-            if concat_points is not None:
-                concat_coords = torch.cat([box_coords, concat_points[0]], dim=1)
-                concat_labels = torch.cat([box_labels, concat_points[1]], dim=1)
-                concat_points = (concat_coords, concat_labels)
-            else:
-                concat_points = (box_coords, box_labels)
-
-        sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
-            points=concat_points,
-            boxes=None,
-            masks=mask_input,
-        )
+        if sparse_embeddings is not None:
+            assert (
+                boxes is None
+            ), "Precomputed point embeddings can't be mixed with boxes"
+            dense_embeddings = self._embed_dense(mask_input, len(sparse_embeddings))
+            batched_mode = len(sparse_embeddings) > 1
+        else:
+            concat_points = self._concat_points_and_boxes(
+                point_coords, point_labels, boxes
+            )
+            sparse_embeddings, dense_embeddings = self.model.sam_prompt_encoder(
+                points=concat_points,
+                boxes=None,
+                masks=mask_input,
+            )
+            batched_mode = (
+                concat_points is not None and concat_points[0].shape[0] > 1
+            )  # multi object prediction
 
         # Predict masks
-        batched_mode = (
-            concat_points is not None and concat_points[0].shape[0] > 1
-        )  # multi object prediction
         high_res_features = [
             feat_level[img_idx].unsqueeze(0)
             for feat_level in self._features["high_res_feats"]
         ]
-        low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
-            image_embeddings=self._features["image_embed"][img_idx].unsqueeze(0),
-            image_pe=self.model.sam_prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
-            multimask_output=multimask_output,
+        low_res_masks, iou_predictions = self._run_mask_decoder(
+            self._features["image_embed"][img_idx].unsqueeze(0),
+            high_res_features,
+            sparse_embeddings,
+            dense_embeddings,
+            multimask_output,
             repeat_image=batched_mode,
-            high_res_features=high_res_features,
         )
 
         # Upscale the masks to the original image resolution
         masks = self._transforms.postprocess_masks(
-            low_res_masks, self._orig_hw[img_idx]
+            low_res_masks, self._orig_hw[img_idx] if upscale_masks else None
         )
         low_res_masks = torch.clamp(low_res_masks, -32.0, 32.0)
         if not return_logits:
@@ -437,6 +840,106 @@ class SAM2ImagePredictor:
 
         return masks, iou_predictions, low_res_masks
 
+    def _run_mask_decoder(
+        self,
+        image_embeddings: torch.Tensor,
+        high_res_features: List[torch.Tensor],
+        sparse_embeddings: torch.Tensor,
+        dense_embeddings: torch.Tensor,
+        multimask_output: bool,
+        repeat_image: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run the mask decoder on embedded prompts, returning the low res mask logits
+        and the IoU predictions. With repeat_image, the (single) image embeddings are
+        shared by all prompts, otherwise there are embeddings for each prompt.
+        """
+        low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=self._get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+            repeat_image=repeat_image,
+            high_res_features=high_res_features,
+        )
+        return low_res_masks, iou_predictions
+
+    def _get_dense_pe(self) -> torch.Tensor:
+        """
+        Return the dense positional encoding of the image embeddings. It only depends
+        on the embedding size (i.e. on the model resolution) and on the prompt
+        encoder weights, so it is computed once and reused across predictions.
+        """
+        prompt_encoder = self.model.sam_prompt_encoder
+        key = (tuple(prompt_encoder.image_embedding_size), self._prompt_encoder_key())
+        if self._dense_pe is None or self._dense_pe[0] != key:
+            self._dense_pe = (key, prompt_encoder.get_dense_pe())
+        return self._dense_pe[1]
+
+    def _prompt_encoder_key(self) -> Tuple:
+        """
+        A key identifying the current prompt encoder weights (their device, dtype and
+        in-place version counters), for invalidating the cached prompt embeddings when
+        the weights are reloaded or moved.
+        """
+        prompt_encoder = self.model.sam_prompt_encoder
+        tensors = [*prompt_encoder.parameters(), *prompt_encoder.buffers()]
+        return tuple((t.device, t.dtype, t._version) for t in tensors)
+
+    def _embed_points(
+        self, point_coords: torch.Tensor, point_labels: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Embed BxNx2 point prompts (already transformed to the input frame) with the
+        prompt encoder, for reuse with the 'sparse_embeddings' argument of '_predict'.
+        """
+        sparse_embeddings, _ = self.model.sam_prompt_encoder(
+            points=(point_coords, point_labels), boxes=None, masks=None
+        )
+        return sparse_embeddings
+
+    def _embed_dense(self, mask_input: Optional[torch.Tensor], batch_size: int):
+        # The dense prompt embeddings of the mask inputs (or of no mask input)
+        prompt_encoder = self.model.sam_prompt_encoder
+        if mask_input is not None:
+            return prompt_encoder._embed_masks(mask_input)
+        h, w = prompt_encoder.image_embedding_size
+        return prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
+            batch_size, -1, h, w
+        )
+
+    def _concat_points_and_boxes(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Merge the transformed point and box prompts into a single (coords, labels)
+        input for the prompt encoder, where boxes are added at the beginning as two
+        corner points with labels 2 and 3.
+        """
+        if point_coords is not None:
+            concat_points = (point_coords, point_labels)
+        else:
+            concat_points = None
+
+        if boxes is not None:
+            box_coords = boxes.reshape(-1, 2, 2)
+            # (built on the device, to avoid a host to device copy)
+            box_labels = torch.arange(2, 4, dtype=torch.int, device=boxes.device)
+            box_labels = box_labels.repeat(boxes.size(0), 1)
+            # we merge "boxes" and "points" into a single "concat_points" input (where
+            # boxes are added at the beginning) to sam_prompt_encoder
+            if concat_points is not None:
+                concat_coords = torch.cat([box_coords, concat_points[0]], dim=1)
+                concat_labels = torch.cat([box_labels, concat_points[1]], dim=1)
+                concat_points = (concat_coords, concat_labels)
+            else:
+                concat_points = (box_coords, box_labels)
+        return concat_points
+
     def get_image_embedding(self) -> torch.Tensor:
         """
         Returns the image embeddings for the currently set image, with
@@ -452,6 +955,91 @@ class SAM2ImagePredictor:
         ), "Features must exist if an image has been set."
         return self._features["image_embed"]
 
+    def export_image_embedding(
+        self,
+        path: str,
+        img_idx: Optional[int] = None,
+        dtype=np.float16,
+        metadata: Optional[dict] = None,
+    ) -> None:
+        """
+        Export the embeddings of the currently set image(s) to a compact,
+        memory-mappable file, which can be loaded with 'set_image_embedding' to
+        prompt the image without running the image encoder again.
+
+        Arguments:
+          path (str): The output file.
+          img_idx (int or None): If not None, only export the embeddings of this
+            image of the batch (and load them as a single image).
+          dtype (np.dtype): The dtype to store the embeddings in, float16 by
+            default (float32 stores them exactly).
+          metadata (dict or None): Additional JSON-serializable metadata to store.
+        """
+        if not self._is_image_set:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) before exporting its embedding."
+            )
+        features, orig_hw, is_batch = self._features, self._orig_hw, self._is_batch
+        if img_idx is not None:
+            features = {
+                "image_embed": features["image_embed"][img_idx : img_idx + 1],
+                "high_res_feats": [
+                    feat[img_idx : img_idx + 1] for feat in features["high_res_feats"]
+                ],
+            }
+            orig_hw, is_batch = [orig_hw[img_idx]], False
+        save_image_embedding(
+            path,
+            features,
+            orig_hw,
+            resolution=self.model.image_size,
+            is_batch=is_batch,
+            dtype=dtype,
+            metadata=metadata,
+        )
+
+    def set_image_embedding(
+        self,
+        embedding: Union[str, dict],
+        orig_hw: Optional[List[Tuple[int, int]]] = None,
+    ) -> None:
+        """
+        Sets precomputed image embeddings, allowing masks to be predicted with the
+        'predict' (or 'predict_batch') method without running the image encoder.
+
+        Arguments:
+          embedding (str or dict): A file exported with 'export_image_embedding', or
+            a dict with the "image_embed" and "high_res_feats" arrays or tensors (each
+            with a leading batch dimension).
+          orig_hw (list(tuple(int, int)) or None): The original size of each image,
+            in (H, W) format. Only needed (and only used) if 'embedding' is a dict.
+        """
+        self.reset_predictor()
+        is_batch = False
+        if isinstance(embedding, (str, os.PathLike)):
+            features, header = load_image_embedding(embedding)
+            if header["resolution"] != self.model.image_size:
+                raise ValueError(
+                    f"The embeddings were computed at resolution {header['resolution']}, "
+                    f"but the model runs at resolution {self.model.image_size}"
+                )
+            orig_hw = header["orig_hw"]
+            is_batch = header["is_batch"]
+        else:
+            features = embedding
+            if orig_hw is None:
+                raise ValueError("orig_hw must be provided with in-memory embeddings")
+            is_batch = len(orig_hw) > 1
+        if len(orig_hw) != len(features["image_embed"]):
+            raise ValueError(
+                f"Got {len(orig_hw)} image sizes for {len(features['image_embed'])} embeddings"
+            )
+
+        self._features = embedding_to_torch(features, self.device)
+        self._orig_hw = [tuple(hw) for hw in orig_hw]
+        self._is_image_set = True
+        self._is_batch = is_batch
+
     @property
     def device(self) -> torch.device:
         return self.model.device
@@ -464,3 +1052,195 @@ class SAM2ImagePredictor:
         self._features = None
         self._orig_hw = None
         self._is_batch = False
+
+
+class SAM2ImagePredictorOptimized(SAM2ImagePredictor):
+    """Optimized for low latency prompting"""
+
+    def __init__(
+        self,
+        sam_model: SAM2Base,
+        prompt_buckets: Tuple[int, ...] = (1, 2, 4, 8, 16, 32, 64),
+        compile_decoder: bool = True,
+        use_cuda_graphs: bool = True,
+        **kwargs,
+    ) -> None:
+        """
+        A SAM2ImagePredictor that runs the mask decoder on a few fixed shapes, so that
+        its invocations can be compiled and, on GPU, captured in CUDA graphs. The
+        latency of a click is otherwise dominated by the launch overhead of the many
+        small kernels of the mask decoder.
+
+        The number of prompts of each decoder call is padded up to the next size in
+        prompt_buckets (by repeating the last prompt, whose outputs are then dropped),
+        and a compiled decoder and CUDA graph are built for each bucket on first use
+        (which may be slow). The number of points per prompt is not padded, since
+        padding points would change the predicted masks. Calls with more prompts than
+        the largest bucket, with per-prompt image embeddings (as in 'predict_batch')
+        or with autograd enabled run the decoder as usual.
+
+        The decoder can be called from several threads, e.g. by the pipelined
+        SAM2AutomaticMaskGenerator (pipeline_batches=True), which decodes on a worker
+        thread and its own CUDA stream. All CUDA graphs share one memory pool (and
+        each graph its static inputs and outputs), so their replays must not overlap:
+        compiled decoder calls and graph replays are serialized by a lock, and each
+        replay waits (on the GPU) for the previous one, whichever stream it ran on.
+
+        Arguments:
+          sam_model (Sam-2): The model to use for mask prediction.
+          prompt_buckets (tuple(int)): The padded numbers of prompts per decoder call.
+          compile_decoder (bool): Whether to compile the mask decoder with
+            torch.compile. On CPU, this is the only optimization (with the inductor
+            CPU backend).
+          use_cuda_graphs (bool): Whether to capture the decoder invocations in CUDA
+            graphs on GPU, and replay them on static copies of the inputs.
+          **kwargs: The other arguments of SAM2ImagePredictor.
+        """
+        super().__init__(sam_model, **kwargs)
+        self.prompt_buckets = sorted(prompt_buckets)
+        self.use_cuda_graphs = use_cuda_graphs and self.device.type == "cuda"
+        self._decode = self._decode_eager
+        if compile_decoder:
+            self._decode = torch.compile(
+                self._decode_eager,
+                mode=(
+                    "max-autotune-no-cudagraphs"
+                    if self.device.type == "cuda"
+                    else "default"
+                ),
+                fullgraph=True,
+                dynamic=False,
+            )
+        self._graph_runners = {}
+        self._graph_pool = None
+        # Serializes the compiled decoder calls and the graph replays across threads
+        self._decode_lock = threading.Lock()
+        # Recorded after the last graph replay, on the stream it ran on
+        self._replay_done = None
+
+    def _decode_eager(
+        self,
+        image_embeddings: torch.Tensor,
+        image_pe: torch.Tensor,
+        sparse_embeddings: torch.Tensor,
+        dense_embeddings: torch.Tensor,
+        *high_res_features: torch.Tensor,
+        multimask_output: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        low_res_masks, iou_predictions, _, _ = self.model.sam_mask_decoder(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+            repeat_image=True,
+            high_res_features=list(high_res_features),
+        )
+        return low_res_masks, iou_predictions
+
+    def _run_mask_decoder(
+        self,
+        image_embeddings: torch.Tensor,
+        high_res_features: List[torch.Tensor],
+        sparse_embeddings: torch.Tensor,
+        dense_embeddings: torch.Tensor,
+        multimask_output: bool,
+        repeat_image: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        num_prompts = len(sparse_embeddings)
+        bucket = next((b for b in self.prompt_buckets if b >= num_prompts), None)
+        if bucket is None or len(image_embeddings) > 1 or torch.is_grad_enabled():
+            return super()._run_mask_decoder(
+                image_embeddings,
+                high_res_features,
+                sparse_embeddings,
+                dense_embeddings,
+                multimask_output,
+                repeat_image,
+            )
+
+        # Pad the prompts to the bucket size (the prompts are decoded independently)
+        dense_embeddings = dense_embeddings.expand(num_prompts, -1, -1, -1)
+        if bucket > num_prompts:
+            padding = bucket - num_prompts
+            sparse_embeddings = torch.cat(
+                [sparse_embeddings, sparse_embeddings[-1:].expand(padding, -1, -1)]
+            )
+            dense_embeddings = torch.cat(
+                [dense_embeddings, dense_embeddings[-1:].expand(padding, -1, -1, -1)]
+            )
+        inputs = (
+            image_embeddings,
+            self._get_dense_pe(),
+            sparse_embeddings,
+            dense_embeddings.contiguous(),
+            *high_res_features,
+        )
+        with self._decode_lock:
+            if self.use_cuda_graphs:
+                low_res_masks, iou_predictions = self._replay_graph(
+                    inputs, multimask_output
+                )
+            else:
+                low_res_masks, iou_predictions = self._decode(
+                    *inputs, multimask_output=multimask_output
+                )
+        return low_res_masks[:num_prompts], iou_predictions[:num_prompts]
+
+    def _replay_graph(
+        self, inputs: Tuple[torch.Tensor, ...], multimask_output: bool
+    ) -> Tuple[torch.Tensor, ...]:
+        # Must be called with _decode_lock held
+        key = (
+            multimask_output,
+            torch.is_autocast_enabled(),
+            tuple((x.shape, x.dtype) for x in inputs),
+        )
+        stream = torch.cuda.current_stream()
+        if self._replay_done is not None:
+            # Don't overwrite the static inputs or the pool while a replay issued on
+            # another stream may still be running
+            stream.wait_event(self._replay_done)
+        runner = self._graph_runners.get(key)
+        if runner is None:
+            if self._graph_pool is None:
+                self._graph_pool = torch.cuda.graph_pool_handle()
+            runner = _CUDAGraphRunner(
+                partial(self._decode, multimask_output=multimask_output),
+                inputs,
+                self._graph_pool,
+            )
+            self._graph_runners[key] = runner
+        outputs = runner(*inputs)
+        self._replay_done = torch.cuda.Event()
+        self._replay_done.record(stream)
+        return outputs
+
+
+class _CUDAGraphRunner:
+    """
+    Captures `fn` in a CUDA graph on static copies of its tensor inputs, and replays
+    it on new inputs (of the same shapes) by copying them into the static ones.
+    """
+
+    def __init__(self, fn, inputs, pool) -> None:
+        self.static_inputs = [x.clone() for x in inputs]
+        # Warm up on a side stream before capturing, as required for CUDA graphs
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                fn(*self.static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        # (thread_local, so that CUDA calls of other threads don't invalidate it)
+        with torch.cuda.graph(self.graph, pool=pool, capture_error_mode="thread_local"):
+            self.static_outputs = fn(*self.static_inputs)
+
+    def __call__(self, *inputs):
+        for static_input, x in zip(self.static_inputs, inputs):
+            if static_input.data_ptr() != x.data_ptr():
+                static_input.copy_(x)
+        self.graph.replay()
+        # The static outputs are overwritten by the next replay
+        return tuple(out.clone() for out in self.static_outputs)
@@ -0,0 +1,380 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from PIL.Image import Image
+
+from sam2.modeling.sam2_base import SAM2Base
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.utils.embedding_cache import ImageEmbeddingCache
+
+# The logit of the pixels that are not covered by any of the tiles of a prompt
+_BACKGROUND_LOGIT = -32.0
+
+
+class SAM2TiledImagePredictor:
+    def __init__(
+        self,
+        sam_model: SAM2Base,
+        tile_size: Optional[int] = None,
+        tile_overlap: Optional[int] = None,
+        tiles_per_batch: int = 4,
+        max_cached_tiles: Optional[int] = None,
+        mask_threshold=0.0,
+        max_hole_area=0.0,
+        max_sprinkle_area=0.0,
+        embedding_cache: Optional[ImageEmbeddingCache] = None,
+    ) -> None:
+        """
+        Predicts masks on images much larger than the model resolution (e.g.
+        aerial mosaics), without downscaling them to the model resolution as a
+        whole. The image is split into overlapping tiles that are embedded
+        separately, each prompt is decoded on the tiles covering it, and the mask
+        logits of these tiles are stitched together, with linearly blended weights
+        in the overlaps.
+
+        The tiles are embedded lazily (tiles_per_batch at a time) when a prompt
+        first needs them, and their embeddings are kept for the following
+        prompts, so that prompting the same area again only runs the mask
+        decoder.
+
+        Arguments:
+          sam_model (Sam-2): The model to use for mask prediction.
+          tile_size (int or None): The side of the square tiles in pixels. Defaults
+            to the model resolution, so that the tiles are embedded at their
+            native resolution.
+          tile_overlap (int or None): The minimum overlap of adjacent tiles in
+            pixels, over which their logits are blended. Defaults to a quarter of
+            tile_size.
+          tiles_per_batch (int): The number of tiles embedded at once.
+          max_cached_tiles (int or None): If not None, the maximum number of tile
+            embeddings kept for the current image (the least recently used ones
+            are dropped first).
+          mask_threshold (float): The threshold to use when converting mask logits
+            to binary masks. Masks are thresholded at 0 by default.
+          max_hole_area (int): If max_hole_area > 0, we fill small holes in up to
+            the maximum area of max_hole_area in the low res masks of each tile.
+          max_sprinkle_area (int): If max_sprinkle_area > 0, we remove small
+            sprinkles up to the maximum area of max_sprinkle_area in the low res
+            masks of each tile.
+          embedding_cache (ImageEmbeddingCache or None): If not None, the tile
+            embeddings are also cached (by tile content) across images.
+        """
+        self.predictor = SAM2ImagePredictor(
+            sam_model,
+            mask_threshold=mask_threshold,
+            max_hole_area=max_hole_area,
+            max_sprinkle_area=max_sprinkle_area,
+            embedding_cache=embedding_cache,
+        )
+        self.model = sam_model
+        self.tile_size = tile_size if tile_size is not None else sam_model.image_size
+        self.tile_overlap = (
+            tile_overlap if tile_overlap is not None else self.tile_size // 4
+        )
+        if not 0 <= self.tile_overlap < self.tile_size:
+            raise ValueError("tile_overlap must be in [0, tile_size).")
+        self.tiles_per_batch = tiles_per_batch
+        self.max_cached_tiles = max_cached_tiles
+        self.mask_threshold = mask_threshold
+
+        # Predictor state
+        self._image = None
+        self._orig_hw = None
+        self.tile_boxes = None
+        self._tile_features = OrderedDict()
+
+    @torch.no_grad()
+    def set_image(
+        self, image: Union[np.ndarray, Image], embed_all_tiles: bool = False
+    ) -> None:
+        """
+        Sets the image to predict masks on, and splits it into tiles.
+
+        Arguments:
+          image (np.ndarray or PIL Image): The input image in RGB format, in HWC
+            format if np.ndarray, with pixel values in [0, 255].
+          embed_all_tiles (bool): If true, embed all tiles now, otherwise each tile
+            is embedded when it is first prompted.
+        """
+        self.reset_predictor()
+        image = np.asarray(image)
+        self._image = image
+        self._orig_hw = image.shape[:2]
+        self.tile_boxes = generate_tile_boxes(
+            self._orig_hw, self.tile_size, self.tile_overlap
+        )
+        if embed_all_tiles:
+            self.embed_tiles(range(len(self.tile_boxes)))
+
+    @torch.no_grad()
+    def embed_tiles(self, tile_inds) -> None:
+        """
+        Embed the given tiles of the current image that are not embedded yet,
+        tiles_per_batch at a time.
+        """
+        if self._image is None:
+            raise RuntimeError("An image must be set with .set_image(...) first.")
+        missing = [i for i in tile_inds if i not in self._tile_features]
+        for start in range(0, len(missing), self.tiles_per_batch):
+            batch_inds = missing[start : start + self.tiles_per_batch]
+            tiles = []
+            for i in batch_inds:
+                x0, y0, x1, y1 = self.tile_boxes[i]
+                tiles.append(self._image[y0:y1, x0:x1])
+            self.predictor.set_image_batch(tiles)
+            features = self.predictor._features
+            for j, i in enumerate(batch_inds):
+                # clone so that the kept tiles don't hold on to the whole batch
+                self._tile_features[i] = {
+                    "image_embed": features["image_embed"][j : j + 1].clone(),
+                    "high_res_feats": [
+                        feat[j : j + 1].clone() for feat in features["high_res_feats"]
+                    ],
+                }
+            self.predictor.reset_predictor()
+        # Drop the least recently used tiles, but never the requested ones
+        for i in tile_inds:
+            self._tile_features.move_to_end(i)
+        if self.max_cached_tiles is not None:
+            max_tiles = max(self.max_cached_tiles, len(set(tile_inds)))
+            while len(self._tile_features) > max_tiles:
+                self._tile_features.popitem(last=False)
+
+    @torch.no_grad()
+    def predict(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Predict masks for a single prompt on the current image.
+
+        The prompt is decoded on the tiles covering it: with a box, all tiles
+        overlapping the box (each with the part of the box inside it), otherwise
+        all tiles containing a foreground point (or any point, without foreground
+        points). Each tile only gets the points inside it. The mask is stitched
+        from these tiles only, so parts of an object outside all of them are not
+        segmented: use tiles larger than the objects, or a box prompt covering
+        the object.
+
+        Arguments:
+          point_coords (np.ndarray or None): A Nx2 array of point prompts to the
+            model. Each point is in (X,Y) in pixels of the image.
+          point_labels (np.ndarray or None): A length N array of labels for the
+            point prompts. 1 indicates a foreground point and 0 indicates a
+            background point.
+          box (np.ndarray or None): A length 4 array given a box prompt to the
+            model, in XYXY format in pixels of the image.
+          multimask_output (bool): If true, the model will return three masks.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of a binary mask (with a logit of -32 outside the tiles of
+            the prompt).
+
+        Returns:
+          (np.ndarray): The output masks in CxHxW format, where C is the
+            number of masks, and (H, W) is the original image size.
+          (np.ndarray): An array of length C containing the model's
+            predictions for the quality of each mask, averaged over the tiles
+            weighted by the (blending weighted) mask area in each tile.
+        """
+        if self._image is None:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) before mask prediction."
+            )
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            point_coords = np.asarray(point_coords, dtype=np.float32).reshape(-1, 2)
+            point_labels = np.asarray(point_labels, dtype=np.int32).reshape(-1)
+        if box is not None:
+            box = np.asarray(box, dtype=np.float32).reshape(4)
+        tile_prompts = self._route_prompt(point_coords, point_labels, box)
+        if len(tile_prompts) == 0:
+            raise ValueError("The prompt is outside of the image.")
+
+        # Decode the prompt on all its tiles at once
+        tile_inds = [i for i, _, _, _ in tile_prompts]
+        self.embed_tiles(tile_inds)
+        self.predictor.set_image_embedding(
+            {
+                "image_embed": torch.cat(
+                    [self._tile_features[i]["image_embed"] for i in tile_inds]
+                ),
+                "high_res_feats": [
+                    torch.cat(feats)
+                    for feats in zip(
+                        *[self._tile_features[i]["high_res_feats"] for i in tile_inds]
+                    )
+                ],
+            },
+            [self._tile_hw(i) for i in tile_inds],
+        )
+        if len(tile_prompts) == 1:
+            _, coords, labels, tile_box = tile_prompts[0]
+            logits, ious, _ = self.predictor.predict(
+                coords, labels, tile_box, None, multimask_output, return_logits=True
+            )
+            tile_logits, tile_ious = [logits], [ious]
+        else:
+            tile_logits, tile_ious, _ = self.predictor.predict_batch(
+                [coords for _, coords, _, _ in tile_prompts],
+                [labels for _, _, labels, _ in tile_prompts],
+                [tile_box for _, _, _, tile_box in tile_prompts],
+                multimask_output=multimask_output,
+                return_logits=True,
+            )
+        self.predictor.reset_predictor()
+        return self._stitch(tile_inds, tile_logits, tile_ious, return_logits)
+
+    def _tile_hw(self, tile_idx: int) -> Tuple[int, int]:
+        x0, y0, x1, y1 = self.tile_boxes[tile_idx]
+        return y1 - y0, x1 - x0
+
+    def _route_prompt(
+        self,
+        point_coords: Optional[np.ndarray],
+        point_labels: Optional[np.ndarray],
+        box: Optional[np.ndarray],
+    ) -> List[Tuple[int, Any, Any, Any]]:
+        """
+        Returns the (tile_idx, point_coords, point_labels, box) prompts of the tiles
+        covering a prompt, in the coordinates of each tile.
+        """
+        tile_prompts = []
+        for tile_idx, (x0, y0, x1, y1) in enumerate(self.tile_boxes):
+            offset = np.array([x0, y0], dtype=np.float32)
+            tile_box = None
+            if box is not None:
+                if box[0] >= x1 or box[2] <= x0 or box[1] >= y1 or box[3] <= y0:
+                    continue
+                tile_box = np.concatenate(
+                    [np.maximum(box[:2], offset), np.minimum(box[2:], [x1, y1])]
+                ) - np.tile(offset, 2)
+            coords, labels = None, None
+            if point_coords is not None:
+                inside = (
+                    (point_coords[:, 0] >= x0)
+                    & (point_coords[:, 0] < x1)
+                    & (point_coords[:, 1] >= y0)
+                    & (point_coords[:, 1] < y1)
+                )
+                if box is None:
+                    positive = point_labels == 1
+                    routed = positive if positive.any() else np.ones_like(inside)
+                    if not (inside & routed).any():
+                        continue
+                if inside.any():
+                    coords = point_coords[inside] - offset
+                    labels = point_labels[inside]
+            tile_prompts.append((tile_idx, coords, labels, tile_box))
+        return tile_prompts
+
+    def _stitch(
+        self,
+        tile_inds: List[int],
+        tile_logits: List[np.ndarray],
+        tile_ious: List[np.ndarray],
+        return_logits: bool,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Blend the CxhxW mask logits of the tiles into the image, weighting each tile
+        by a ramp over tile_overlap pixels from its edges inside the image.
+        """
+        tile_boxes = np.array([self.tile_boxes[i] for i in tile_inds])
+        rx0, ry0 = tile_boxes[:, :2].min(axis=0)
+        rx1, ry1 = tile_boxes[:, 2:].max(axis=0)
+        num_masks = tile_logits[0].shape[0]
+        logit_sum = np.zeros((num_masks, ry1 - ry0, rx1 - rx0), dtype=np.float32)
+        weight_sum = np.zeros((ry1 - ry0, rx1 - rx0), dtype=np.float32)
+        iou_sum = np.zeros(num_masks, dtype=np.float32)
+        iou_weight = np.zeros(num_masks, dtype=np.float32)
+        for (x0, y0, x1, y1), logits, ious in zip(tile_boxes, tile_logits, tile_ious):
+            weight = np.outer(
+                self._edge_ramp(y0, y1, self._orig_hw[0]),
+                self._edge_ramp(x0, x1, self._orig_hw[1]),
+            )
+            region = np.s_[y0 - ry0 : y1 - ry0, x0 - rx0 : x1 - rx0]
+            logit_sum[(slice(None),) + region] += logits * weight
+            weight_sum[region] += weight
+            mask_weight = ((logits > self.mask_threshold) * weight).sum(axis=(1, 2))
+            iou_sum += ious * mask_weight
+            iou_weight += mask_weight
+
+        covered = weight_sum > 0
+        logits = np.full_like(logit_sum, _BACKGROUND_LOGIT)
+        np.divide(logit_sum, weight_sum, out=logits, where=covered)
+        ious = np.where(
+            iou_weight > 0,
+            iou_sum / np.maximum(iou_weight, 1e-6),
+            np.mean(tile_ious, axis=0),
+        )
+
+        h, w = self._orig_hw
+        if return_logits:
+            masks = np.full((num_masks, h, w), _BACKGROUND_LOGIT, dtype=np.float32)
+            masks[:, ry0:ry1, rx0:rx1] = logits
+        else:
+            masks = np.zeros((num_masks, h, w), dtype=bool)
+            masks[:, ry0:ry1, rx0:rx1] = logits > self.mask_threshold
+        return masks, ious.astype(np.float32)
+
+    def _edge_ramp(self, start: int, end: int, length: int) -> np.ndarray:
+        # 1D blending weights of a tile, ramping up over tile_overlap pixels from
+        # its edges that are inside the image (and constant at the image borders)
+        pos = np.arange(end - start, dtype=np.float32) + 0.5
+        ramp = np.ones(end - start, dtype=np.float32)
+        if self.tile_overlap > 0 and start > 0:
+            ramp = np.minimum(ramp, pos / self.tile_overlap)
+        if self.tile_overlap > 0 and end < length:
+            ramp = np.minimum(ramp, (end - start - pos) / self.tile_overlap)
+        return ramp
+
+    @property
+    def device(self) -> torch.device:
+        return self.predictor.device
+
+    def reset_predictor(self) -> None:
+        """
+        Resets the image and the tile embeddings.
+        """
+        self.predictor.reset_predictor()
+        self._image = None
+        self._orig_hw = None
+        self.tile_boxes = None
+        self._tile_features = OrderedDict()
+
+
+def generate_tile_boxes(
+    orig_size: Tuple[int, ...], tile_size: int, tile_overlap: int
+) -> List[List[int]]:
+    """
+    Generates the XYXY boxes of square tiles of side tile_size covering an image,
+    evenly spaced so that adjacent tiles overlap by at least tile_overlap pixels.
+    Tiles are clipped to images smaller than tile_size.
+    """
+    im_h, im_w = orig_size[:2]
+
+    def tile_starts(length):
+        if length <= tile_size:
+            return [0]
+        n_tiles = math.ceil((length - tile_overlap) / (tile_size - tile_overlap))
+        return np.linspace(0, length - tile_size, n_tiles).round().astype(int).tolist()
+
+    return [
+        [x0, y0, min(x0 + tile_size, im_w), min(y0 + tile_size, im_h)]
+        for y0 in tile_starts(im_h)
+        for x0 in tile_starts(im_w)
+    ]
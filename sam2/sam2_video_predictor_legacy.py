@@ -47,6 +47,10 @@ class SAM2VideoPredictor(SAM2Base):
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        is_lidar=False,
+        frame_transform=None,
+        single_channel=False,
+        resize_frames_on_device=False,
     ):
         """Initialize an inference state."""
         compute_device = self.device  # device of the model
@@ -56,6 +60,10 @@ class SAM2VideoPredictor(SAM2Base):
             offload_video_to_cpu=offload_video_to_cpu,
             async_loading_frames=async_loading_frames,
             compute_device=compute_device,
+            is_lidar=is_lidar,
+            frame_transform=frame_transform,
+            single_channel=single_channel,
+            resize_frames_on_device=resize_frames_on_device,
         )
         inference_state = {}
         inference_state["images"] = images
@@ -7,14 +7,172 @@
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 import numpy as np
 import torch
 
+try:
+    from pycocotools import mask as mask_utils  # type: ignore
+except ImportError:
+    mask_utils = None
+
 # Very lightly adapted from https://github.com/facebookresearch/segment-anything/blob/main/segment_anything/utils/amg.py
 
 
+class MaskRLEs:
+    """
+    A batch of uncompressed RLEs of masks of the same size, stored in columnar
+    format: the counts of all masks in one flat int32 array, and the offsets of
+    the counts of each mask in it. Indexing with an int returns the RLE dict of a
+    mask (in the format expected by pycoco tools), which is only built on access.
+    Indexing with an array of indices or a boolean mask returns a new MaskRLEs.
+    """
+
+    def __init__(
+        self,
+        counts: np.ndarray,
+        offsets: np.ndarray,
+        size: List[int],
+        areas: Optional[np.ndarray] = None,
+    ):
+        self.counts = np.asarray(counts, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.size = [int(size[0]), int(size[1])]
+        self._areas = areas
+
+    @classmethod
+    def from_masks(cls, masks: torch.Tensor) -> "MaskRLEs":
+        """Encode a BxHxW batch of binary masks."""
+        counts, offsets, areas = mask_to_rle_counts(masks, return_areas=True)
+        return cls(counts, offsets, masks.shape[1:], areas)
+
+    @classmethod
+    def from_list(cls, rles: List[Dict[str, Any]], size: List[int]) -> "MaskRLEs":
+        """Build from a list of RLE dicts of masks of the given size."""
+        lengths = [len(rle["counts"]) for rle in rles]
+        counts = np.fromiter(
+            (c for rle in rles for c in rle["counts"]), np.int32, sum(lengths)
+        )
+        return cls(counts, np.concatenate([[0], np.cumsum(lengths)]), size)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx) -> Any:
+        if isinstance(idx, (int, np.integer)):
+            counts = self.counts[self.offsets[idx] : self.offsets[idx + 1]]
+            return {"size": list(self.size), "counts": counts.tolist()}
+        if isinstance(idx, torch.Tensor):
+            idx = idx.detach().cpu().numpy()
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        areas = None if self._areas is None else self._areas[idx]
+        return self._gather(
+            self.counts, self.offsets[:-1][idx], self.lengths[idx], self.size, areas
+        )
+
+    @staticmethod
+    def _gather(counts, starts, lengths, size, areas=None) -> "MaskRLEs":
+        # Gather the counts[starts[i] : starts[i] + lengths[i]] of each mask i
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        src = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return MaskRLEs(counts[src], offsets, size, areas)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def cat(self, other: "MaskRLEs") -> "MaskRLEs":
+        assert self.size == other.size, "Can't concatenate RLEs of different sizes."
+        areas = None
+        if self._areas is not None and other._areas is not None:
+            areas = np.concatenate([self._areas, other._areas])
+        return MaskRLEs(
+            np.concatenate([self.counts, other.counts]),
+            np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]),
+            self.size,
+            areas,
+        )
+
+    def replace(self, inds: np.ndarray, other: "MaskRLEs") -> "MaskRLEs":
+        """Return a copy with the RLEs at `inds` replaced by the RLEs of `other`."""
+        assert self.size == other.size, "Can't mix RLEs of different sizes."
+        inds = np.asarray(inds, dtype=np.int64)
+        starts, lengths = self.offsets[:-1].copy(), self.lengths
+        starts[inds] = len(self.counts) + other.offsets[:-1]
+        lengths[inds] = other.lengths
+        areas = self.areas.copy()
+        areas[inds] = other.areas
+        counts = np.concatenate([self.counts, other.counts])
+        return self._gather(counts, starts, lengths, self.size, areas)
+
+    @property
+    def areas(self) -> np.ndarray:
+        """
+        The area of each mask (the sum of its odd counts). It is computed along
+        with the counts when encoding masks, and carried through indexing.
+        """
+        if self._areas is None:
+            parity = self._count_parity()
+            mask_inds = np.repeat(np.arange(len(self)), self.lengths)
+            self._areas = np.bincount(
+                mask_inds, weights=self.counts * parity, minlength=len(self)
+            ).astype(np.int64)
+        return self._areas
+
+    def _count_parity(self) -> np.ndarray:
+        # Whether each count is a run of 1s (the odd counts of each mask)
+        pos = np.arange(len(self.counts)) - np.repeat(self.offsets[:-1], self.lengths)
+        return (pos % 2).astype(bool)
+
+    def to_masks(
+        self, out: Optional[np.ndarray] = None, chunk_size: int = 64
+    ) -> np.ndarray:
+        """
+        Decode all RLEs into an NxHxW boolean array. If `out` is given, the masks
+        are decoded `chunk_size` at a time and written to it (which bounds the
+        temporary memory used on top of the output). Otherwise, the masks are
+        decoded at once and returned as a transposed view, like in 'rle_to_mask'.
+        """
+        h, w = self.size
+        parity = self._count_parity()
+        if out is None:
+            # The RLEs are in fortran order, i.e. of the transposed masks
+            flat = np.repeat(parity, self.counts)
+            return flat.reshape(len(self), w, h).transpose(0, 2, 1)
+
+        assert out.shape == (len(self), h, w) and out.dtype == bool
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            c0, c1 = self.offsets[start], self.offsets[end]
+            flat = np.repeat(parity[c0:c1], self.counts[c0:c1])
+            out[start:end].transpose(0, 2, 1)[...] = flat.reshape(end - start, w, h)
+        return out
+
+    def values_at(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Return the NxP values of all masks at P integer (x, y) pixel coordinates,
+        looked up in the RLEs without decoding the masks.
+        """
+        h, w = self.size
+        pixels = np.asarray(pixels, dtype=np.int64)
+        # The position of each pixel in fortran order, and in the concatenation of
+        # all masks (the counts of each mask sum to h * w)
+        positions = pixels[:, 0] * h + pixels[:, 1]
+        positions = np.arange(len(self))[:, None] * (h * w) + positions[None, :]
+        run_ends = np.cumsum(self.counts, dtype=np.int64)
+        return self._count_parity()[np.searchsorted(run_ends, positions, "right")]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
@@ -24,14 +182,14 @@ class MaskData:
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, MaskRLEs)
+            ), "MaskData only supports list, numpy arrays, torch tensors and MaskRLEs."
         self._stats = dict(**kwargs)
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, MaskRLEs)
+        ), "MaskData only supports list, numpy arrays, torch tensors and MaskRLEs."
         self._stats[key] = item
 
     def __delitem__(self, key: str) -> None:
@@ -51,6 +209,8 @@ class MaskData:
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
                 self._stats[k] = v[keep.detach().cpu().numpy()]
+            elif isinstance(v, MaskRLEs):
+                self._stats[k] = v[keep]
             elif isinstance(v, list) and keep.dtype == torch.bool:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
@@ -60,7 +220,11 @@ class MaskData:
 
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
-            if k not in self._stats or self._stats[k] is None:
+            if isinstance(v, MaskRLEs):
+                # MaskRLEs are never modified in place, so they don't need a copy
+                old = self._stats.get(k)
+                self._stats[k] = v if old is None else old.cat(v)
+            elif k not in self._stats or self._stats[k] is None:
                 self._stats[k] = deepcopy(v)
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = torch.cat([self._stats[k], v], dim=0)
@@ -106,47 +270,90 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
-def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+def mask_to_rle_counts(
+    tensor: torch.Tensor, return_areas: bool = False
+) -> Tuple[np.ndarray, ...]:
     """
-    Encodes masks to an uncompressed RLE, in the format expected by
-    pycoco tools.
+    Encodes a BxHxW batch of masks to uncompressed RLEs (in the format expected by
+    pycoco tools), computing the run lengths of all masks at once. Returns the
+    counts of all masks as one flat int32 array, and the B+1 offsets of the counts
+    of each mask in it (the counts of mask i are counts[offsets[i]:offsets[i+1]]).
+    If return_areas is True, the area of each mask is also returned.
     """
     # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
+    device = tensor.device
+    if b == 0:
+        empty = np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+        return empty + (np.zeros(0, dtype=np.int64),) if return_areas else empty
 
-    # Compute change indices
+    # Compute change indices (sorted by mask, then by position)
     diff = tensor[:, 1:] ^ tensor[:, :-1]
     change_indices = diff.nonzero()
+    mask_inds, positions = change_indices[:, 0], change_indices[:, 1] + 1
+    num_changes = torch.bincount(mask_inds, minlength=b)
+
+    # Each mask has num_changes + 1 runs. The j-th change (of mask m) ends run j + m
+    # and starts run j + m + 1, while the first run of each mask starts at 0 and
+    # the last one ends at h * w. The sizes below are derived from the number of
+    # changes, which nonzero already synchronized, so that the counts are copied
+    # to the host with a single other synchronization.
+    num_runs = num_changes + 1
+    total_runs = len(positions) + b
+    run_inds = torch.arange(len(positions), device=device) + mask_inds
+    run_ends = torch.full((total_runs,), h * w, device=device)
+    run_ends[run_inds] = positions
+    run_starts = torch.zeros_like(run_ends)
+    run_starts[run_inds + 1] = positions
+    run_lengths = run_ends - run_starts
+
+    # Counts start with the number of 0s, so masks starting with a 1 get a leading
+    # 0. The counts are written to a buffer large enough for all masks to start with
+    # a 1, which is trimmed on the host.
+    starts_with_one = tensor[:, 0].long()
+    num_counts = num_runs + starts_with_one
+    run_mask_inds = torch.repeat_interleave(
+        torch.arange(b, device=device), num_runs, output_size=total_runs
+    )
+    counts = torch.zeros(total_runs + b, dtype=torch.int32, device=device)
+    counts[
+        torch.arange(len(run_lengths), device=device)
+        + torch.cumsum(starts_with_one, dim=0)[run_mask_inds]
+    ] = run_lengths.int()
+    offsets = torch.cat([num_counts.new_zeros(1), torch.cumsum(num_counts, dim=0)])
+
+    # Copy the counts, offsets (and areas) to the host at once
+    outputs = [counts, offsets.int()]
+    if return_areas:
+        outputs.append(tensor.sum(dim=1, dtype=torch.int32))
+    out = torch.cat(outputs).cpu().numpy()
+    counts, out = out[: len(counts)], out[len(counts) :].astype(np.int64)
+    counts = counts[: out[b]]
+    if return_areas:
+        return counts, out[: b + 1], out[b + 1 :]
+    return counts, out
 
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+
+def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """
+    Encodes masks to an uncompressed RLE, in the format expected by
+    pycoco tools.
+    """
+    b, h, w = tensor.shape
+    counts, offsets = mask_to_rle_counts(tensor)
+    return [
+        {"size": [h, w], "counts": counts[offsets[i] : offsets[i + 1]].tolist()}
+        for i in range(b)
+    ]
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # The runs alternate between 0s and 1s, starting with 0s
+    mask = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -293,6 +500,57 @@ def remove_small_regions(
     return mask, True
 
 
+def remove_small_regions_batch(
+    masks: torch.Tensor, area_thresh: float
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Batched equivalent of 'remove_small_regions' with mode "holes" followed by mode
+    "islands", on an NxHxW stack of binary masks. The connected components of all
+    masks are computed at once (falling back to OpenCV mask by mask if the
+    connected components op fails). Returns the masks and a boolean tensor of
+    shape N indicating which masks have been modified.
+    """
+    try:
+        return _remove_small_regions_cc(masks, area_thresh)
+    except (ImportError, RuntimeError):
+        new_masks, changed = [], []
+        for mask in masks.cpu().numpy():
+            mask, holes_changed = remove_small_regions(mask, area_thresh, "holes")
+            mask, islands_changed = remove_small_regions(mask, area_thresh, "islands")
+            new_masks.append(torch.as_tensor(mask))
+            changed.append(holes_changed or islands_changed)
+        new_masks = torch.stack(new_masks).reshape(masks.shape).to(masks.device)
+        return new_masks, torch.tensor(changed, dtype=torch.bool, device=masks.device)
+
+
+def _remove_small_regions_cc(
+    masks: torch.Tensor, area_thresh: float
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    from sam2.utils.misc import get_connected_components
+
+    # Fill the small holes (the small connected components of the background)
+    _, areas = get_connected_components(~masks[:, None])
+    small_holes = ~masks & (areas[:, 0] < area_thresh)
+    masks = masks | small_holes
+    changed = small_holes.flatten(1).any(dim=1)
+
+    # Remove the small islands (the small connected components of the foreground)
+    labels, areas = get_connected_components(masks[:, None])
+    labels, areas = labels[:, 0], areas[:, 0]
+    small_islands = masks & (areas < area_thresh)
+    changed |= small_islands.flatten(1).any(dim=1)
+    new_masks = masks & ~small_islands
+
+    # If every island of a mask is small, keep the largest one (on ties, the one
+    # appearing first in raster order, which has the lowest label in OpenCV)
+    all_small = masks.flatten(1).any(dim=1) & ~new_masks.flatten(1).any(dim=1)
+    if all_small.any():
+        first_largest = areas[all_small].flatten(1).argmax(dim=1, keepdim=True)
+        largest_labels = labels[all_small].flatten(1).gather(1, first_largest)
+        new_masks[all_small] = labels[all_small] == largest_labels[:, :, None]
+    return new_masks, changed
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
@@ -302,6 +560,61 @@ def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     return rle
 
 
+def compress_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compress an uncompressed RLE to the COCO string format. Uses pycocotools when
+    it is installed, and otherwise a pure Python encoder that gives the same
+    result: each count (minus the count two runs before it, after the first three)
+    is written as a little-endian sequence of 5-bit groups, each stored in one
+    character offset by 48, with bit 6 marking that more groups follow.
+    """
+    if mask_utils is not None:
+        rle = coco_encode_rle(uncompressed_rle)
+        return {"size": list(rle["size"]), "counts": rle["counts"]}
+    counts = uncompressed_rle["counts"]
+    chars = []
+    for i, x in enumerate(counts):
+        x = int(x)
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return {"size": list(uncompressed_rle["size"]), "counts": "".join(chars)}
+
+
+def mask_nms(
+    masks: torch.Tensor, scores: torch.Tensor, iou_threshold: float
+) -> torch.Tensor:
+    """
+    Non-maximum suppression of binary masks (of shape NxHxW) by mask IoU. Returns
+    the indices of the kept masks, sorted by decreasing score.
+    """
+    if len(masks) == 0:
+        return torch.zeros(0, dtype=torch.long, device=masks.device)
+    flat = masks.flatten(1).float()
+    intersections = flat @ flat.T
+    areas = flat.sum(dim=1)
+    unions = areas[:, None] + areas[None, :] - intersections
+    ious = intersections / unions.clamp(min=1)
+
+    # Greedily keep the masks by decreasing score
+    order = torch.argsort(scores, descending=True)
+    overlaps = (ious[order][:, order] > iou_threshold).cpu().numpy()
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if not suppressed[i]:
+            keep.append(i)
+            suppressed |= overlaps[i]
+    return order[torch.as_tensor(keep, device=order.device)]
+
+
 def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
     """
     Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
@@ -0,0 +1,137 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+from sam2.utils.amg import compress_rle
+
+
+class AnnotationWriter:
+    """
+    Writes mask records (as returned by SAM2AutomaticMaskGenerator) as COCO-style
+    annotations, one image at a time. The annotations of an image are serialized
+    and written one by one as they are consumed from an iterable, so that with
+    'SAM2AutomaticMaskGenerator.generate_stream', only the masks of the current
+    image are held in memory (in compact RLE form) and never their JSON encoding.
+
+    Each image is written in the per-image format of the SA-1B dataset:
+      {"image": {"image_id": ..., "height": ..., "width": ..., ...},
+       "annotations": [{"id": ..., "image_id": ..., "segmentation": ..., ...}]}
+    where the segmentations are COCO RLEs with compressed string counts, the
+    annotation ids run across all written images, and the other keys of each
+    annotation are those of the mask records (bbox, area, predicted_iou,
+    stability_score, point_coords, crop_box).
+
+    Arguments:
+      output_path (str): With layout='jsonl', the file to write (one line per
+        image). With layout='per_image', the directory to write one JSON file per
+        image to, named after the image id.
+      layout (str): Either 'jsonl' or 'per_image'.
+      append (bool): With layout='jsonl', append to an existing output file
+        instead of overwriting it.
+    """
+
+    def __init__(
+        self, output_path: str, layout: str = "jsonl", append: bool = False
+    ) -> None:
+        if layout not in ["jsonl", "per_image"]:
+            raise ValueError(f"Unknown layout {layout}.")
+        self.output_path = output_path
+        self.layout = layout
+        self.append = append
+        self.num_images = 0
+        self.num_annotations = 0
+        self._file = None
+        if layout == "jsonl":
+            parent = os.path.dirname(output_path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            self._file = open(output_path, "a" if append else "w")
+        else:
+            os.makedirs(output_path, exist_ok=True)
+
+    def write(
+        self,
+        image_id: Any,
+        records: Iterable[Dict[str, Any]],
+        height: int,
+        width: int,
+        image_info: Optional[Dict[str, Any]] = None,
+    ) -> int:
+        """
+        Writes the mask records of one image, consuming them one at a time.
+
+        Arguments:
+          image_id (int or str): The id of the image (also the file name of the
+            image with layout='per_image').
+          records (iterable(dict(str, any))): The mask records of the image, with
+            'segmentation' as an uncompressed or a COCO RLE (the output modes
+            'uncompressed_rle' and 'coco_rle' of the mask generator).
+          height (int): The height of the image.
+          width (int): The width of the image.
+          image_info (dict(str, any) or None): Additional JSON-serializable
+            fields of the image entry (e.g. "file_name").
+
+        Returns:
+          (int): The number of annotations written for the image.
+        """
+        if self.layout == "jsonl" and self._file is None:
+            raise ValueError("Can't write to a closed AnnotationWriter.")
+        image = {"image_id": image_id, "height": int(height), "width": int(width)}
+        image.update(image_info or {})
+        if self.layout == "jsonl":
+            num_annotations = self._write_image(self._file, image, records)
+            self._file.write("\n")
+            self._file.flush()
+        else:
+            # Write to a temporary file first so that interrupted runs never leave
+            # truncated image files behind.
+            path = os.path.join(self.output_path, f"{image_id}.json")
+            with open(path + ".tmp", "w") as f:
+                num_annotations = self._write_image(f, image, records)
+            os.replace(path + ".tmp", path)
+        self.num_images += 1
+        return num_annotations
+
+    def _write_image(self, f, image: Dict[str, Any], records) -> int:
+        f.write('{"image": ' + json.dumps(image) + ', "annotations": [')
+        num_annotations = 0
+        for record in records:
+            ann = self._record_to_annotation(record, image["image_id"])
+            f.write((", " if num_annotations > 0 else "") + json.dumps(ann))
+            num_annotations += 1
+        f.write("]}")
+        return num_annotations
+
+    def _record_to_annotation(self, record: Dict[str, Any], image_id: Any):
+        segmentation = record["segmentation"]
+        if isinstance(segmentation, np.ndarray):
+            raise ValueError(
+                "Binary mask segmentations can't be written, use the output_mode "
+                "'uncompressed_rle' or 'coco_rle' of the mask generator."
+            )
+        if not isinstance(segmentation["counts"], str):
+            segmentation = compress_rle(segmentation)
+        ann = {"id": self.num_annotations, "image_id": image_id}
+        ann.update(record)
+        ann["segmentation"] = segmentation
+        self.num_annotations += 1
+        return ann
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "AnnotationWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,136 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+
+
+def _features_nbytes(features: Dict[str, Any]) -> int:
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _features_to(features: Dict[str, Any], device) -> Dict[str, Any]:
+    return {
+        "image_embed": features["image_embed"].to(device),
+        "high_res_feats": [feat.to(device) for feat in features["high_res_feats"]],
+    }
+
+
+class ImageEmbeddingCache:
+    def __init__(
+        self,
+        max_bytes: int = 2 * 1024**3,
+        cache_dir: Optional[str] = None,
+        namespace: str = "",
+    ) -> None:
+        """
+        An LRU cache of image embeddings (the `_features` of SAM2ImagePredictor),
+        keyed by the content hash of the image and the model resolution. Setting an
+        image that was already embedded (e.g. when reopening an image in an annotation
+        tool, or the same crop in the automatic mask generator) then skips the image
+        encoder entirely.
+
+        Arguments:
+          max_bytes (int): The maximum total size of the embeddings kept in memory.
+            The least recently used embeddings are evicted beyond this budget.
+          cache_dir (str or None): If not None, embeddings are also persisted in this
+            directory, so that they survive evictions and restarts.
+          namespace (str): Included in the cache keys. Set it (e.g. to the checkpoint
+            name) when sharing a cache directory between different models.
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, image: np.ndarray, resolution: int) -> str:
+        """Return the cache key of an HWC image embedded at the given resolution."""
+        image = np.ascontiguousarray(image)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{self.namespace}|{resolution}|{image.shape}|{image.dtype}|".encode())
+        h.update(memoryview(image).cast("B"))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key: str, device=None) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached embeddings for `key` (on `device` if given), or None. On a
+        memory miss, the embeddings are loaded from the cache directory if present.
+        """
+        with self._lock:
+            features = self._entries.get(key)
+            if features is not None:
+                self._entries.move_to_end(key)
+        if features is None and self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                try:
+                    features = torch.load(path, map_location=device, weights_only=True)
+                except Exception as e:
+                    logging.warning(f"Failed to load cached embeddings {path}: {e}")
+                    return None
+                self._insert(key, features)
+        if features is not None and device is not None:
+            features = _features_to(features, device)
+        return features
+
+    def put(self, key: str, features: Dict[str, Any]) -> None:
+        """Add the embeddings of an image to the cache (and to the cache directory)."""
+        self._insert(key, features)
+        if self.cache_dir is not None and not os.path.exists(self._path(key)):
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                torch.save(_features_to(features, "cpu"), tmp_path)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f"Failed to persist embeddings to {path}: {e}")
+
+    def _insert(self, key: str, features: Dict[str, Any]) -> None:
+        nbytes = _features_nbytes(features)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= _features_nbytes(old)
+            self._entries[key] = features
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= _features_nbytes(evicted)
+
+    def clear(self) -> None:
+        """Drop all in-memory embeddings (the cache directory is left untouched)."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        if key in self._entries:
+            return True
+        return self.cache_dir is not None and os.path.exists(self._path(key))
@@ -0,0 +1,158 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+# Image embedding files start with this magic string, followed by the length of the
+# JSON header (as a little-endian uint64), the JSON header itself, and the raw
+# tensor data (each tensor aligned to _ALIGNMENT bytes, so that they can be
+# memory-mapped directly).
+EMBEDDING_MAGIC = b"SAM2EMB\x00"
+EMBEDDING_FORMAT_VERSION = 1
+_ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def save_image_embedding(
+    path: str,
+    features: Dict[str, Any],
+    orig_hw: List[Tuple[int, int]],
+    resolution: int,
+    is_batch: bool = False,
+    dtype=np.float16,
+    metadata: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Save image embeddings (the `_features` of SAM2ImagePredictor) to a single
+    memory-mappable file, along with their shapes, dtypes and the original image
+    sizes.
+
+    Arguments:
+      path (str): The output file.
+      features (dict): The "image_embed" tensor and the list of "high_res_feats"
+        tensors, each with a leading batch dimension.
+      orig_hw (list(tuple(int, int))): The original size of each image of the batch.
+      resolution (int): The model input resolution the embeddings were computed at.
+      is_batch (bool): Whether the embeddings were set with 'set_image_batch'.
+      dtype (np.dtype): The dtype to store the embeddings in. float16 halves the file
+        size, float32 stores them exactly.
+      metadata (dict or None): Additional JSON-serializable metadata to store.
+    """
+    dtype = np.dtype(dtype)
+    tensors = [("image_embed", features["image_embed"])]
+    for i, feat in enumerate(features["high_res_feats"]):
+        tensors.append((f"high_res_feats.{i}", feat))
+    arrays = [
+        (name, t.detach().float().cpu().numpy().astype(dtype, copy=False))
+        for name, t in tensors
+    ]
+
+    # the tensor offsets are relative to the start of the data section
+    entries, offset = [], 0
+    for name, arr in arrays:
+        offset = _align(offset)
+        entries.append(
+            {
+                "name": name,
+                "shape": list(arr.shape),
+                "dtype": arr.dtype.str,
+                "offset": offset,
+            }
+        )
+        offset += arr.nbytes
+    header = {
+        "version": EMBEDDING_FORMAT_VERSION,
+        "resolution": resolution,
+        "orig_hw": [list(hw) for hw in orig_hw],
+        "is_batch": is_batch,
+        "tensors": entries,
+        "metadata": metadata or {},
+    }
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(EMBEDDING_MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(EMBEDDING_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for entry, (_, arr) in zip(entries, arrays):
+            f.seek(data_start + entry["offset"])
+            f.write(arr.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_image_embedding(
+    path: str, mmap: bool = True
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Load image embeddings saved with `save_image_embedding`.
+
+    Arguments:
+      path (str): The embedding file.
+      mmap (bool): Whether to memory-map the tensors instead of reading them.
+
+    Returns:
+      (dict): The "image_embed" array and the list of "high_res_feats" arrays, as
+        (possibly memory-mapped, read-only) numpy arrays in their stored dtype.
+      (dict): The header, with the "resolution", "orig_hw", "is_batch" and
+        "metadata" entries.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(EMBEDDING_MAGIC)) != EMBEDDING_MAGIC:
+            raise ValueError(f"{path} is not a SAM 2 image embedding file")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    if header["version"] > EMBEDDING_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported embedding file version {header['version']} in {path}"
+        )
+    data_start = _align(len(EMBEDDING_MAGIC) + 8 + header_len)
+
+    arrays = {}
+    for entry in header["tensors"]:
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        offset = data_start + entry["offset"]
+        if mmap:
+            arr = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            count = int(np.prod(shape))
+            arr = np.fromfile(path, dtype=dtype, count=count, offset=offset)
+            arr = arr.reshape(shape)
+        arrays[entry["name"]] = arr
+
+    num_levels = sum(name.startswith("high_res_feats.") for name in arrays)
+    features = {
+        "image_embed": arrays["image_embed"],
+        "high_res_feats": [arrays[f"high_res_feats.{i}"] for i in range(num_levels)],
+    }
+    return features, header
+
+
+def embedding_to_torch(
+    features: Dict[str, Any], device, dtype=torch.float32
+) -> Dict[str, Any]:
+    """Convert loaded embedding arrays (or tensors) to tensors of `dtype` on `device`."""
+
+    def _to_torch(arr):
+        if not isinstance(arr, torch.Tensor):
+            # memory-mapped arrays are read-only, so copy them into a tensor
+            arr = torch.from_numpy(np.array(arr))
+        return arr.to(device=device, dtype=dtype)
+
+    return {
+        "image_embed": _to_torch(features["image_embed"]),
+        "high_res_feats": [_to_torch(feat) for feat in features["high_res_feats"]],
+    }
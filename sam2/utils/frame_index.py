@@ -0,0 +1,126 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import re
+from typing import Dict, List, Tuple
+
+# Frame file extensions (matched case-insensitively)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+# Name of the optional manifest file persisting the frame index of a folder
+MANIFEST_FILENAME = ".sam2_frame_index.json"
+
+# In-process cache of frame indices, keyed by (folder, extensions) and validated
+# against the modification time of the folder
+_FRAME_INDEX_CACHE: Dict[Tuple[str, Tuple[str, ...]], Tuple[int, List[str]]] = {}
+
+
+def natural_sort_key(name: str):
+    """
+    Sort key that orders the numbers in a file name by value, so that e.g. "2.jpg"
+    comes before "10.jpg" (and ties are broken by the full name).
+    """
+    stem = os.path.splitext(name)[0]
+    # The digit runs captured by the split are at the odd indices (and always
+    # parse as int, unlike any string for which str.isdigit is true, e.g. "²")
+    parts = [
+        int(p) if i % 2 == 1 else p.lower()
+        for i, p in enumerate(re.split(r"(\d+)", stem))
+    ]
+    return parts, name
+
+
+def _scan_frames(folder: str, extensions: Tuple[str, ...]) -> List[str]:
+    with os.scandir(folder) as it:
+        frame_names = [
+            entry.name
+            for entry in it
+            if os.path.splitext(entry.name)[-1].lower() in extensions
+            and entry.is_file()
+        ]
+    frame_names.sort(key=natural_sort_key)
+    return frame_names
+
+
+def _read_manifest(folder: str, extensions: Tuple[str, ...], mtime_ns: int):
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("mtime_ns") != mtime_ns:
+        return None
+    if tuple(manifest.get("extensions", ())) != extensions:
+        return None
+    return manifest["frames"]
+
+
+def _write_manifest(folder: str, extensions: Tuple[str, ...], frame_names: List[str]):
+    manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+    manifest = {"mtime_ns": None, "extensions": list(extensions), "frames": frame_names}
+    try:
+        # Creating the manifest changes the folder's modification time, so we record
+        # the folder's modification time after creating it and then rewrite the file
+        # in place (which doesn't change the folder's modification time again).
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        manifest["mtime_ns"] = os.stat(folder).st_mtime_ns
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+    except OSError:
+        # read-only folders simply don't get a manifest
+        return None
+    return manifest["mtime_ns"]
+
+
+def list_frames(
+    folder: str,
+    extensions: Tuple[str, ...] = IMAGE_EXTENSIONS,
+    use_manifest: bool = False,
+) -> List[str]:
+    """
+    List the frame file names in a folder, in natural sort order.
+
+    The folder is scanned once with `os.scandir` and the index is cached in memory
+    (until the folder's modification time changes), so repeated calls for the same
+    video (e.g. by the frame loader and the VOS inference script) don't list the
+    folder again. With `use_manifest=True`, the index is also persisted as a manifest
+    file in the folder, which avoids listing large folders (e.g. on network file
+    systems) across processes.
+
+    Arguments:
+      folder (str): The folder containing the frames.
+      extensions (tuple(str)): The frame file extensions, matched case-insensitively.
+      use_manifest (bool): Whether to read and write a manifest file in the folder.
+
+    Returns:
+      (list(str)): The frame file names (without the folder).
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    folder_key = os.path.abspath(folder)
+    cache_key = (folder_key, extensions)
+    mtime_ns = os.stat(folder_key).st_mtime_ns
+    cached = _FRAME_INDEX_CACHE.get(cache_key)
+    if cached is not None and cached[0] == mtime_ns:
+        return list(cached[1])
+
+    frame_names = None
+    if use_manifest:
+        frame_names = _read_manifest(folder_key, extensions, mtime_ns)
+    if frame_names is None:
+        frame_names = _scan_frames(folder_key, extensions)
+        if use_manifest:
+            mtime_ns = _write_manifest(folder_key, extensions, frame_names) or mtime_ns
+    _FRAME_INDEX_CACHE[cache_key] = (mtime_ns, frame_names)
+    return list(frame_names)
+
+
+def list_frame_stems(folder: str, **kwargs) -> List[str]:
+    """Like `list_frames`, but returns the frame names without their extension."""
+    return [os.path.splitext(p)[0] for p in list_frames(folder, **kwargs)]
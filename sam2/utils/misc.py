@@ -6,14 +6,21 @@
 
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from threading import Thread
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
-from tqdm import tqdm
-from scipy.ndimage import convolve1d
+from scipy import fft as scipy_fft
+from scipy.ndimage import convolve1d, label as ndimage_label
 from scipy.signal import firwin
+from tqdm import tqdm
+
+from sam2.utils.frame_index import list_frames
+
 
 def get_sdpa_settings():
     if torch.cuda.is_available():
@@ -58,10 +65,61 @@ def get_connected_components(mask):
               for foreground pixels and 0 for background pixels.
     - counts: A tensor of shape (N, 1, H, W) containing the area of the connected
               components for foreground pixels and 0 for background pixels.
+
+    The CUDA extension is used for CUDA tensors when it is available, and a
+    multithreaded CPU implementation otherwise (whose labels may differ from
+    those of the CUDA extension, but which finds the same components).
     """
-    from sam2 import _C
+    if mask.is_cuda:
+        try:
+            from sam2 import _C
+        except ImportError:
+            _C = None
+        if _C is not None:
+            return _C.get_connected_componnets(mask.to(torch.uint8).contiguous())
+    return _get_connected_components_cpu(mask)
+
+
+# 8-connectivity structuring element for `ndimage_label`
+_CC_STRUCTURE = np.ones((3, 3), dtype=bool)
+
 
-    return _C.get_connected_componnets(mask.to(torch.uint8).contiguous())
+@lru_cache(maxsize=1)
+def _get_cc_thread_pool():
+    """
+    The thread pool of `_get_connected_components_cpu`, created on first use and
+    shared by all calls (which run once per frame or image).
+    """
+    return ThreadPoolExecutor(
+        max_workers=os.cpu_count() or 1, thread_name_prefix="sam2_cc"
+    )
+
+
+def _get_connected_components_cpu(mask, num_threads=None):
+    """
+    CPU implementation of `get_connected_components`, labelling the masks of the
+    batch in at most `num_threads` parallel tasks (`ndimage_label` releases the
+    GIL while labelling).
+    """
+    mask_np = mask.to(torch.bool).cpu().numpy()
+    labels = np.zeros(mask_np.shape, dtype=np.int32)
+    counts = np.zeros(mask_np.shape, dtype=np.int32)
+
+    def _label(inds):
+        for i in inds:
+            ndimage_label(mask_np[i, 0], structure=_CC_STRUCTURE, output=labels[i, 0])
+            areas = np.bincount(labels[i, 0].ravel()).astype(np.int32)
+            areas[0] = 0  # background
+            counts[i, 0] = areas[labels[i, 0]]
+
+    num_threads = num_threads or min(len(mask_np), os.cpu_count() or 1)
+    if num_threads > 1:
+        pool = _get_cc_thread_pool()
+        list(pool.map(_label, np.array_split(np.arange(len(mask_np)), num_threads)))
+    else:
+        _label(range(len(mask_np)))
+    labels, counts = torch.from_numpy(labels), torch.from_numpy(counts)
+    return labels.to(mask.device), counts.to(mask.device)
 
 
 def mask_to_box(masks: torch.Tensor):
@@ -90,46 +148,277 @@ def mask_to_box(masks: torch.Tensor):
     return bbox_coords
 
 
-# def _load_img_as_tensor(img_path, image_size, is_lidar: bool = False):
-#     img_pil = Image.open(img_path)
-#     img_np = np.array(img_pil.convert("RGB").resize((image_size, image_size)))
-#     # TODO: filtrare lidar images
-#     if is_lidar:
-#         img_np = artifact_filter(image, artifact_frequency=0.25, epsilon=0.04, taps=33)
-#     if img_np.dtype == np.uint8:  # np.uint8 is expected for JPEG images
-#         img_np = img_np / 255.0
-#     else:
-#         raise RuntimeError(f"Unknown image dtype: {img_np.dtype} on {img_path}")
-#     img = torch.from_numpy(img_np).permute(2, 0, 1)
-#     video_width, video_height = img_pil.size  # the original video size
-#     return img, video_height, video_width
-
-def _load_img_as_tensor(img_path, image_size, is_lidar: bool = False):
-    img_pil = Image.open(img_path).convert("RGB")  # Convert to RGB first
-    img_np = np.array(img_pil)
-
-    # Apply LiDAR artifact filtering before resizing
-    if is_lidar:
-        img_np = artifact_filter(img_np, artifact_frequency=0.25, epsilon=0.04, taps=33)
-
-    # Now resize the filtered image
-    img_pil = Image.fromarray(np.clip(img_np, 0, 255).astype(np.uint8))  # Ensure valid image range and type
-    img_np = np.array(img_pil.resize((image_size, image_size)))
-
-    # Normalize
-    if img_np.dtype == np.uint8:
-        img_np = img_np / 255.0
-    else:
-        raise RuntimeError(f"Unknown image dtype: {img_np.dtype} on {img_path}")
+class LidarArtifactFilter:
+    """
+    Frame transform that removes the periodic scan-line artifacts of LiDAR intensity
+    images (see `artifact_filter`).
+
+    Arguments:
+      engine (str): "fir" runs the spatial FIR convolutions of `artifact_filter`,
+        "fft" runs the equivalent frequency-domain filter of `artifact_filter_fft`.
+      at_model_resolution (bool): If True, the frame is first resized (with
+        anti-aliasing) to the model resolution and the filter is applied there,
+        with its cutoff frequencies rescaled to the resized pixel grid. This is much
+        cheaper for sensor images that are larger than the model resolution.
+    """
+
+    def __init__(
+        self,
+        engine="fir",
+        at_model_resolution=False,
+        artifact_frequency=0.25,
+        epsilon=0.04,
+        taps=33,
+    ):
+        assert engine in ["fir", "fft"], f"Unknown engine {engine}"
+        self.engine = engine
+        self.at_model_resolution = at_model_resolution
+        self.artifact_frequency = artifact_frequency
+        self.epsilon = epsilon
+        self.taps = taps
+
+    def __call__(self, img_np, scale=(1.0, 1.0)):
+        """
+        Filter a HxWxC (or HxW) image. `scale` is the (vertical, horizontal) ratio
+        between the native and the current pixel size of the image, which is used to
+        rescale the cutoff frequencies when filtering at model resolution.
+        """
+        if self.engine == "fft":
+            return artifact_filter_fft(
+                img_np, self.artifact_frequency, self.taps, self.epsilon, scale=scale
+            )
+        assert scale == (1.0, 1.0), "the FIR engine only supports native resolution"
+        return artifact_filter(img_np, self.artifact_frequency, self.taps, self.epsilon)
+
+
+def lidar_artifact_filter(img_np):
+    """
+    Built-in frame transform that removes the periodic scan-line artifacts of LiDAR
+    intensity images (see `artifact_filter`).
+    """
+    return artifact_filter(img_np, artifact_frequency=0.25, epsilon=0.04, taps=33)
+
+
+# Built-in per-frame transforms that can be selected by name in the video loaders
+FRAME_TRANSFORMS = {
+    "lidar": lidar_artifact_filter,
+    # same output as "lidar" (up to float rounding), filtering in the frequency domain
+    "lidar_fft": LidarArtifactFilter(engine="fft"),
+    # filter after the anti-aliased resize to the model resolution
+    "lidar_lowres": LidarArtifactFilter(engine="fft", at_model_resolution=True),
+}
+
 
-    # Convert to torch tensor
-    img = torch.from_numpy(img_np).permute(2, 0, 1)  # CHW format
+def get_frame_transform(frame_transform=None, is_lidar=False):
+    """
+    Resolve the per-frame preprocessing hook used by the video frame loaders.
+
+    `frame_transform` can be None, the name of a built-in transform in
+    `FRAME_TRANSFORMS` (e.g. "lidar"), or a callable that takes a HxWxC image
+    array at its native resolution and returns an array of the same shape. The
+    legacy `is_lidar=True` flag is equivalent to `frame_transform="lidar"`.
+    """
+    if frame_transform is None and is_lidar:
+        frame_transform = "lidar"
+    if isinstance(frame_transform, str):
+        if frame_transform not in FRAME_TRANSFORMS:
+            raise ValueError(
+                f"Unknown frame transform {frame_transform}, expected one of "
+                f"{list(FRAME_TRANSFORMS)} or a callable"
+            )
+        frame_transform = FRAME_TRANSFORMS[frame_transform]
+    assert frame_transform is None or callable(frame_transform)
+    return frame_transform
 
-    # Return original dimensions
-    video_width, video_height = img_pil.size
+
+def _np_to_chw_tensor(img_np):
+    """Convert a HxWxC or (single-channel) HxW array to a CHW tensor."""
+    if img_np.ndim == 2:
+        return torch.from_numpy(img_np)[None]
+    return torch.from_numpy(img_np).permute(2, 0, 1)
+
+
+def _frame_to_tensor(img_np, image_size, frame_transform=None):
+    """
+    Apply `frame_transform` to an RGB (HxWx3) or single-channel (HxW) uint8 frame at
+    its native resolution, then resize it to image_size x image_size and return it as
+    a CHW tensor in [0, 1] (with C=1 for single-channel frames).
+    """
+    if img_np.dtype != np.uint8:  # np.uint8 is expected for JPEG images
+        raise RuntimeError(f"Unknown image dtype: {img_np.dtype}")
+    if getattr(frame_transform, "at_model_resolution", False):
+        # Resize first and apply the frame transform on the model-resolution frame
+        h, w = img_np.shape[:2]
+        img_pil = Image.fromarray(img_np)
+        img_np = np.array(img_pil.resize((image_size, image_size)))
+        img_np = frame_transform(img_np, scale=(h / image_size, w / image_size))
+        img_np = np.clip(img_np, 0, 255) / 255.0
+        return _np_to_chw_tensor(img_np)
+    # Apply the frame transform (e.g. LiDAR artifact filtering) before resizing
+    if frame_transform is not None:
+        img_np = frame_transform(img_np)
+        # Ensure valid image range and type
+        img_np = np.clip(img_np, 0, 255).astype(np.uint8)
+    img_pil = Image.fromarray(img_np)
+    img_np = np.array(img_pil.resize((image_size, image_size))) / 255.0
+    return _np_to_chw_tensor(img_np)
+
+
+def _load_img_as_tensor(
+    img_path, image_size, frame_transform=None, single_channel=False
+):
+    img_pil = Image.open(img_path).convert("L" if single_channel else "RGB")
+    video_width, video_height = img_pil.size  # the original video size
+    try:
+        img = _frame_to_tensor(np.array(img_pil), image_size, frame_transform)
+    except RuntimeError as e:
+        raise RuntimeError(f"{e} on {img_path}") from e
     return img, video_height, video_width
 
 
+def _decode_frame(img_path, frame_transform=None, single_channel=False):
+    """
+    Decode a frame as a HxWx3 (or HxW if single_channel) uint8 array and apply
+    `frame_transform` on it at its native resolution.
+    """
+    img_np = np.array(Image.open(img_path).convert("L" if single_channel else "RGB"))
+    return _apply_native_frame_transform(img_np, frame_transform)
+
+
+def _apply_native_frame_transform(img_np, frame_transform):
+    if frame_transform is None:
+        return img_np
+    if getattr(frame_transform, "at_model_resolution", False):
+        raise ValueError(
+            "frame transforms applied at model resolution are not supported when "
+            "resizing frames on the compute device"
+        )
+    return np.clip(frame_transform(img_np), 0, 255).astype(np.uint8)
+
+
+def _resize_and_normalize_frames(
+    frames, image_size, compute_device, img_mean=None, img_std=None
+):
+    """
+    Upload a list of uint8 frames of the same size (HxWxC or HxW) to `compute_device`
+    and resize them to image_size x image_size (bicubic with anti-aliasing) and
+    normalize them as one batched op. Without `img_mean` and `img_std`, the frames
+    are only scaled to [0, 1]. Returns a NxCxHxW float32 tensor.
+
+    This only approximates the PIL resize of the default path: the bicubic kernels
+    and the rounding differ, and on high-frequency content the normalized outputs
+    can differ by up to ~0.2 (about 0.02 on smooth content).
+    """
+    frames = torch.from_numpy(np.stack(frames))
+    if frames.dim() == 3:
+        frames = frames[..., None]  # single-channel frames
+    if compute_device.type == "cuda":
+        frames = frames.pin_memory()
+    frames = frames.to(compute_device, non_blocking=True)
+    frames = frames.permute(0, 3, 1, 2).float()
+    frames = F.interpolate(
+        frames,
+        size=(image_size, image_size),
+        mode="bicubic",
+        align_corners=False,
+        antialias=True,
+    ).clamp_(0, 255)
+    if img_mean is None:
+        return frames.mul_(1 / 255.0)
+    # (frames / 255 - img_mean) / img_std as a single fused op
+    img_mean = img_mean.to(compute_device)
+    img_std = img_std.to(compute_device)
+    return torch.addcmul(-img_mean / img_std, frames, 1 / (255.0 * img_std))
+
+
+# Max number of frames resized at once when resizing frames on the compute device
+_DEVICE_RESIZE_BATCH_SIZE = 16
+
+
+def _load_frames_on_device(
+    frames,
+    num_frames,
+    image_size,
+    offload_video_to_cpu,
+    img_mean,
+    img_std,
+    compute_device,
+    single_channel=False,
+    desc="frame loading",
+):
+    """
+    Resize and normalize an iterable of decoded uint8 frames on `compute_device`, in
+    batches of up to `_DEVICE_RESIZE_BATCH_SIZE` frames of the same size.
+    """
+    num_channels = 1 if single_channel else 3
+    storage_device = torch.device("cpu") if offload_video_to_cpu else compute_device
+    images = torch.zeros(
+        num_frames,
+        num_channels,
+        image_size,
+        image_size,
+        dtype=torch.float32,
+        device=storage_device,
+    )
+    batch, n = [], 0
+
+    def _flush():
+        out = _resize_and_normalize_frames(
+            batch,
+            image_size,
+            compute_device,
+            img_mean=None if single_channel else img_mean,
+            img_std=None if single_channel else img_std,
+        )
+        images[n - len(batch) : n] = out.to(storage_device)
+        batch.clear()
+
+    for frame in tqdm(frames, total=num_frames, desc=desc):
+        if len(batch) > 0 and (
+            frame.shape != batch[0].shape or len(batch) == _DEVICE_RESIZE_BATCH_SIZE
+        ):
+            _flush()
+        batch.append(frame)
+        n += 1
+    if len(batch) > 0:
+        _flush()
+    video_height, video_width = frame.shape[:2]
+    if single_channel:
+        images = SingleChannelVideoFrames(images, img_mean, img_std, compute_device)
+    return images, video_height, video_width
+
+
+def _normalize_single_channel(img, img_mean, img_std):
+    """
+    Normalize a single-channel (1xHxW) frame with the 3-channel mean and std, which
+    broadcasts it to the 3xHxW input expected by the image encoder.
+    """
+    return (img - img_mean) / img_std
+
+
+class SingleChannelVideoFrames:
+    """
+    A list of single-channel video frames (e.g. LiDAR intensity or range images).
+
+    The frames are stored as Nx1xHxW tensors in [0, 1], which takes a third of the
+    memory of RGB frames; each frame is only broadcast to 3 channels and normalized
+    on the compute device when it is fetched to build the image encoder input.
+    """
+
+    def __init__(self, images, img_mean, img_std, compute_device):
+        self.images = images
+        self.compute_device = compute_device
+        self.img_mean = img_mean.to(compute_device)
+        self.img_std = img_std.to(compute_device)
+
+    def __getitem__(self, index):
+        img = self.images[index].to(self.compute_device, non_blocking=True)
+        return _normalize_single_channel(img, self.img_mean, self.img_std)
+
+    def __len__(self):
+        return len(self.images)
+
+
 class AsyncVideoFrameLoader:
     """
     A list of video frames to be load asynchronously without blocking session start.
@@ -143,7 +432,9 @@ class AsyncVideoFrameLoader:
         img_mean,
         img_std,
         compute_device,
-        is_lidar=False,
+        frame_transform=None,
+        single_channel=False,
+        resize_frames_on_device=False,
     ):
         self.img_paths = img_paths
         self.image_size = image_size
@@ -158,7 +449,15 @@ class AsyncVideoFrameLoader:
         self.video_height = None
         self.video_width = None
         self.compute_device = compute_device
-        self.is_lidar = is_lidar
+        # per-frame preprocessing hook, applied in the loading thread
+        self.frame_transform = frame_transform
+        # single-channel frames are stored as 1xHxW and normalized to 3xHxW on access
+        self.single_channel = single_channel
+        if single_channel:
+            self.img_mean = img_mean.to(compute_device)
+            self.img_std = img_std.to(compute_device)
+        # whether to resize and normalize each frame on the compute device
+        self.resize_frames_on_device = resize_frames_on_device
 
         # load the first frame to fill video_height and video_width and also
         # to cache it (since it's most likely where the user will click)
@@ -168,7 +467,7 @@ class AsyncVideoFrameLoader:
         def _load_frames():
             try:
                 for n in tqdm(range(len(self.images)), desc="frame loading (JPEG)"):
-                    self.__getitem__(n)
+                    self._load_frame(n)
             except Exception as e:
                 self.exception = e
 
@@ -179,18 +478,46 @@ class AsyncVideoFrameLoader:
         if self.exception is not None:
             raise RuntimeError("Failure in frame loading thread") from self.exception
 
+        img = self._load_frame(index)
+        if self.single_channel:
+            img = img.to(self.compute_device, non_blocking=True)
+            img = _normalize_single_channel(img, self.img_mean, self.img_std)
+        return img
+
+    def _load_frame(self, index):
         img = self.images[index]
         if img is not None:
             return img
 
+        if self.resize_frames_on_device:
+            img_np = _decode_frame(
+                self.img_paths[index], self.frame_transform, self.single_channel
+            )
+            self.video_height, self.video_width = img_np.shape[:2]
+            img = _resize_and_normalize_frames(
+                [img_np],
+                self.image_size,
+                self.compute_device,
+                img_mean=None if self.single_channel else self.img_mean,
+                img_std=None if self.single_channel else self.img_std,
+            )[0]
+            if self.offload_video_to_cpu:
+                img = img.cpu()
+            self.images[index] = img
+            return img
+
         img, video_height, video_width = _load_img_as_tensor(
-            self.img_paths[index], self.image_size, is_lidar=self.is_lidar
+            self.img_paths[index],
+            self.image_size,
+            self.frame_transform,
+            single_channel=self.single_channel,
         )
         self.video_height = video_height
         self.video_width = video_width
-        # normalize by mean and std
-        img -= self.img_mean
-        img /= self.img_std
+        if not self.single_channel:
+            # normalize by mean and std
+            img -= self.img_mean
+            img /= self.img_std
         if not self.offload_video_to_cpu:
             img = img.to(self.compute_device, non_blocking=True)
         self.images[index] = img
@@ -209,11 +536,31 @@ def load_video_frames(
     async_loading_frames=False,
     compute_device=torch.device("cuda"),
     is_lidar=False,
+    frame_transform=None,
+    single_channel=False,
+    resize_frames_on_device=False,
 ):
     """
     Load the video frames from video_path. The frames are resized to image_size as in
     the model and are loaded to GPU if offload_video_to_cpu=False. This is used by the demo.
+
+    `frame_transform` is an optional per-frame preprocessing hook applied to each frame
+    at its native resolution before resizing (see `get_frame_transform`); it is used in
+    the same way by the JPEG (sync and async) and the video file loaders.
+    `is_lidar=True` is a shorthand for the built-in "lidar" artifact filter.
+
+    With `single_channel=True` (e.g. for LiDAR intensity or range images), the frames
+    are decoded, filtered and resized as a single channel, and only broadcast to the
+    3 model input channels when they are fetched (see `SingleChannelVideoFrames`).
+
+    With `resize_frames_on_device=True`, the decoded uint8 frames are uploaded to
+    `compute_device` and resized and normalized there in batches (with torch ops,
+    which also works on CPU) instead of being resized with PIL on the CPU. This
+    resize is approximate and not equivalent to the PIL one: on high-frequency
+    content the normalized frames can differ by up to ~0.2 (see
+    `_resize_and_normalize_frames`).
     """
+    frame_transform = get_frame_transform(frame_transform, is_lidar)
     is_bytes = isinstance(video_path, bytes)
     is_str = isinstance(video_path, str)
     is_mp4_path = is_str and os.path.splitext(video_path)[-1] in [".mp4", ".MP4"]
@@ -225,6 +572,9 @@ def load_video_frames(
             img_mean=img_mean,
             img_std=img_std,
             compute_device=compute_device,
+            frame_transform=frame_transform,
+            single_channel=single_channel,
+            resize_frames_on_device=resize_frames_on_device,
         )
     elif is_str and os.path.isdir(video_path):
         return load_video_frames_from_jpg_images(
@@ -235,7 +585,9 @@ def load_video_frames(
             img_std=img_std,
             async_loading_frames=async_loading_frames,
             compute_device=compute_device,
-            is_lidar=is_lidar,
+            frame_transform=frame_transform,
+            single_channel=single_channel,
+            resize_frames_on_device=resize_frames_on_device,
         )
     else:
         raise NotImplementedError(
@@ -252,6 +604,9 @@ def load_video_frames_from_jpg_images(
     async_loading_frames=False,
     compute_device=torch.device("cuda"),
     is_lidar=False,
+    frame_transform=None,
+    single_channel=False,
+    resize_frames_on_device=False,
 ):
     """
     Load the video frames from a directory of JPEG files ("<frame_index>.jpg" format).
@@ -261,6 +616,7 @@ def load_video_frames_from_jpg_images(
 
     You can load a frame asynchronously by setting `async_loading_frames` to `True`.
     """
+    frame_transform = get_frame_transform(frame_transform, is_lidar)
     if isinstance(video_path, str) and os.path.isdir(video_path):
         jpg_folder = video_path
     else:
@@ -274,12 +630,7 @@ def load_video_frames_from_jpg_images(
             "ffmpeg to start the JPEG file from 00000.jpg."
         )
 
-    frame_names = [
-        p
-        for p in os.listdir(jpg_folder)
-        if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG", '.png']
-    ]
-    frame_names.sort(key=lambda p: os.path.splitext(p)[0])
+    frame_names = list_frames(jpg_folder)
     num_frames = len(frame_names)
     if num_frames == 0:
         raise RuntimeError(f"no images found in {jpg_folder}")
@@ -295,12 +646,42 @@ def load_video_frames_from_jpg_images(
             img_mean,
             img_std,
             compute_device,
+            frame_transform=frame_transform,
+            single_channel=single_channel,
+            resize_frames_on_device=resize_frames_on_device,
         )
         return lazy_images, lazy_images.video_height, lazy_images.video_width
 
-    images = torch.zeros(num_frames, 3, image_size, image_size, dtype=torch.float32)
+    if resize_frames_on_device:
+        frames = (
+            _decode_frame(img_path, frame_transform, single_channel)
+            for img_path in img_paths
+        )
+        return _load_frames_on_device(
+            frames,
+            num_frames,
+            image_size,
+            offload_video_to_cpu,
+            img_mean,
+            img_std,
+            compute_device,
+            single_channel=single_channel,
+            desc="frame loading (JPEG)",
+        )
+
+    num_channels = 1 if single_channel else 3
+    images = torch.zeros(
+        num_frames, num_channels, image_size, image_size, dtype=torch.float32
+    )
     for n, img_path in enumerate(tqdm(img_paths, desc="frame loading (JPEG)")):
-        images[n], video_height, video_width = _load_img_as_tensor(img_path, image_size, is_lidar=is_lidar)
+        images[n], video_height, video_width = _load_img_as_tensor(
+            img_path, image_size, frame_transform, single_channel=single_channel
+        )
+    if single_channel:
+        if not offload_video_to_cpu:
+            images = images.to(compute_device)
+        images = SingleChannelVideoFrames(images, img_mean, img_std, compute_device)
+        return images, video_height, video_width
     if not offload_video_to_cpu:
         images = images.to(compute_device)
         img_mean = img_mean.to(compute_device)
@@ -318,21 +699,67 @@ def load_video_frames_from_video_file(
     img_mean=(0.485, 0.456, 0.406),
     img_std=(0.229, 0.224, 0.225),
     compute_device=torch.device("cuda"),
+    is_lidar=False,
+    frame_transform=None,
+    single_channel=False,
+    resize_frames_on_device=False,
 ):
     """Load the video frames from a video file."""
     import decord
 
+    frame_transform = get_frame_transform(frame_transform, is_lidar)
+
     img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
     img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
     # Get the original video height and width
     decord.bridge.set_bridge("torch")
     video_height, video_width, _ = decord.VideoReader(video_path).next().shape
+    if resize_frames_on_device:
+        # decode the frames at native resolution and resize them on the compute device
+        video_reader = decord.VideoReader(video_path)
+        frames = (
+            _apply_native_frame_transform(
+                frame[..., 0].numpy() if single_channel else frame.numpy(),
+                frame_transform,
+            )
+            for frame in video_reader
+        )
+        return _load_frames_on_device(
+            frames,
+            len(video_reader),
+            image_size,
+            offload_video_to_cpu,
+            img_mean,
+            img_std,
+            compute_device,
+            single_channel=single_channel,
+        )
     # Iterate over all frames in the video
     images = []
-    for frame in decord.VideoReader(video_path, width=image_size, height=image_size):
-        images.append(frame.permute(2, 0, 1))
-
-    images = torch.stack(images, dim=0).float() / 255.0
+    if frame_transform is None:
+        for frame in decord.VideoReader(
+            video_path, width=image_size, height=image_size
+        ):
+            if single_channel:
+                # all channels are equal in single-channel videos
+                frame = frame[..., :1]
+            images.append(frame.permute(2, 0, 1))
+        images = torch.stack(images, dim=0).float() / 255.0
+    else:
+        # the frame transform runs at native resolution, so we decode full-size frames
+        # and resize them after the transform (as for JPEG frames)
+        for frame in decord.VideoReader(video_path):
+            frame = frame.numpy()
+            if single_channel:
+                frame = frame[..., 0]
+            images.append(_frame_to_tensor(frame, image_size, frame_transform))
+        images = torch.stack(images, dim=0).float()
+
+    if single_channel:
+        if not offload_video_to_cpu:
+            images = images.to(compute_device)
+        images = SingleChannelVideoFrames(images, img_mean, img_std, compute_device)
+        return images, video_height, video_width
     if not offload_video_to_cpu:
         images = images.to(compute_device)
         img_mean = img_mean.to(compute_device)
@@ -382,14 +809,21 @@ def concat_points(old_point_inputs, new_points, new_labels):
 
     return {"point_coords": points, "point_labels": labels}
 
+
 def artifact_filter(image, artifact_frequency, taps, epsilon, print_params=False):
     image = np.asarray(image, float)
-    return image - lowpass(highpass(image, artifact_frequency, taps, epsilon, print_params), 
-                            taps, epsilon, print_params)
+    return image - lowpass(
+        highpass(image, artifact_frequency, taps, epsilon, print_params),
+        taps,
+        epsilon,
+        print_params,
+    )
 
 
 def highpass(image, distortion_freq, taps, epsilon, print_params=False):
-    highpass_filter = firwin(taps, distortion_freq - epsilon, pass_zero='highpass', fs=1)
+    highpass_filter = firwin(
+        taps, distortion_freq - epsilon, pass_zero="highpass", fs=1
+    )
     if print_params:
         print("Highpass FIR Parameters:")
         print(highpass_filter)
@@ -397,8 +831,67 @@ def highpass(image, distortion_freq, taps, epsilon, print_params=False):
 
 
 def lowpass(image, taps, epsilon, print_params=False):
-    lowpass_filter = firwin(taps, epsilon, pass_zero='lowpass', fs=1)
+    lowpass_filter = firwin(taps, epsilon, pass_zero="lowpass", fs=1)
     if print_params:
         print("Lowpass FIR Parameters:")
         print(lowpass_filter)
     return convolve1d(image, lowpass_filter, axis=1)
+
+
+@lru_cache(maxsize=32)
+def _fir_frequency_response(n, cutoff, taps, pass_zero, onesided):
+    """
+    Frequency response of a `firwin` FIR filter for a (circular) signal of length n,
+    with the filter centered at index 0 so that it matches `convolve1d` alignment.
+    """
+    if pass_zero == "lowpass" and cutoff >= 0.5:
+        # the cutoff is above the Nyquist frequency, i.e. the filter is all-pass
+        kernel = np.zeros(taps)
+        kernel[taps // 2] = 1.0
+    else:
+        kernel = firwin(taps, cutoff, pass_zero=pass_zero, fs=1)
+    kernel_padded = np.zeros(n)
+    kernel_padded[:taps] = kernel
+    kernel_padded = np.roll(kernel_padded, -(taps // 2))
+    return scipy_fft.rfft(kernel_padded) if onesided else scipy_fft.fft(kernel_padded)
+
+
+def artifact_filter_fft(image, artifact_frequency, taps, epsilon, scale=(1.0, 1.0)):
+    """
+    Frequency-domain version of `artifact_filter`. The image is padded by taps // 2
+    pixels with the same boundary mode as `convolve1d` ("reflect"), so for scale=(1, 1)
+    the output matches `artifact_filter` up to float rounding, while the cost is a
+    single 2D FFT and inverse FFT (independent of `taps`) instead of two spatial
+    convolutions.
+
+    `scale` is the (vertical, horizontal) ratio between the native pixel size the
+    filter was designed for and the pixel size of `image` (e.g. 2.0 if the image was
+    downscaled by 2x). The cutoff frequencies are rescaled accordingly; if the
+    highpass band is above the Nyquist frequency of the image (i.e. the artifacts were
+    already removed by an anti-aliased downscale), the image is returned unchanged.
+    """
+    image = np.asarray(image, float)
+    highpass_cutoff = (artifact_frequency - epsilon) * scale[0]
+    lowpass_cutoff = epsilon * scale[1]
+    if highpass_cutoff >= 0.5:
+        return image
+
+    pad = taps // 2
+    pad_width = [(pad, pad), (pad, pad)] + [(0, 0)] * (image.ndim - 2)
+    # numpy's "symmetric" padding is scipy's "reflect" boundary mode
+    padded = np.pad(image, pad_width, mode="symmetric")
+    # zero-pad further to FFT-friendly sizes (the extra samples only wrap around into
+    # the reflected border, which is cropped away below)
+    n_h = scipy_fft.next_fast_len(padded.shape[0], real=True)
+    n_w = scipy_fft.next_fast_len(padded.shape[1], real=True)
+    highpass_response = _fir_frequency_response(
+        n_h, highpass_cutoff, taps, "highpass", onesided=False
+    )
+    lowpass_response = _fir_frequency_response(
+        n_w, lowpass_cutoff, taps, "lowpass", onesided=True
+    )
+    response = np.outer(highpass_response, lowpass_response)
+    response = response.reshape(response.shape + (1,) * (image.ndim - 2))
+    spectrum = scipy_fft.rfft2(padded, s=(n_h, n_w), axes=(0, 1)) * response
+    artifacts = scipy_fft.irfft2(spectrum, s=(n_h, n_w), axes=(0, 1))
+    return image - artifacts[pad : pad + image.shape[0], pad : pad + image.shape[1]]
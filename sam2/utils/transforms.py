@@ -5,7 +5,10 @@
 # LICENSE file in the root directory of this source tree.
 
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -38,10 +41,67 @@ class SAM2Transforms(nn.Module):
         x = self.to_tensor(x)
         return self.transforms(x)
 
-    def forward_batch(self, img_list):
-        img_batch = [self.transforms(self.to_tensor(img)) for img in img_list]
-        img_batch = torch.stack(img_batch, dim=0)
-        return img_batch
+    def forward_batch(self, img_list, device=None, num_workers=0):
+        """
+        Transform a list of HxWxC images (of possibly different sizes) into a
+        normalized Bx3xHxW batch at the model resolution on `device`.
+
+        For uint8 images (the common case), the images are uploaded as uint8, all
+        images of the same size are resized in one batched op, and the whole batch is
+        normalized in a single fused op. If num_workers > 0, the host to device copies
+        are issued from a pool of worker threads to overlap them.
+        """
+        device = torch.device("cpu") if device is None else torch.device(device)
+        if not all(
+            isinstance(img, np.ndarray) and img.dtype == np.uint8 for img in img_list
+        ):
+            img_batch = [self.transforms(self.to_tensor(img)) for img in img_list]
+            img_batch = torch.stack(img_batch, dim=0)
+            return img_batch.to(device)
+
+        def _upload(img):
+            img = torch.from_numpy(np.ascontiguousarray(img))
+            if device.type == "cuda":
+                img = img.pin_memory()
+            return img.to(device, non_blocking=True)
+
+        if num_workers > 0:
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                imgs = list(pool.map(_upload, img_list))
+        else:
+            imgs = [_upload(img) for img in img_list]
+
+        # Resize all images of the same size at once (as `Resize` does on tensors)
+        img_batch = torch.empty(
+            len(imgs), 3, self.resolution, self.resolution, device=device
+        )
+        inds_per_size = defaultdict(list)
+        for i, img in enumerate(imgs):
+            inds_per_size[img.shape].append(i)
+        for inds in inds_per_size.values():
+            x = torch.stack([imgs[i] for i in inds], dim=0).permute(0, 3, 1, 2)
+            img_batch[inds] = F.interpolate(
+                x.float(),
+                (self.resolution, self.resolution),
+                mode="bilinear",
+                align_corners=False,
+                antialias=True,
+            )
+
+        # (img_batch / 255 - mean) / std as a single fused op
+        mean = torch.tensor(self.mean, device=device)[:, None, None]
+        std = torch.tensor(self.std, device=device)[:, None, None]
+        return torch.addcmul(-mean / std, img_batch, 1 / (255.0 * std))
+
+    def coords_scale(self, normalize=False, orig_hw=None):
+        """
+        The (x, y) factors that transform_coords multiplies the coordinates by.
+        """
+        if normalize:
+            assert orig_hw is not None
+            h, w = orig_hw
+            return [self.resolution / w, self.resolution / h]
+        return [float(self.resolution), float(self.resolution)]
 
     def transform_coords(
         self, coords: torch.Tensor, normalize=False, orig_hw=None
@@ -50,18 +110,15 @@ class SAM2Transforms(nn.Module):
         Expects a torch tensor with length 2 in the last dimension. The coordinates can be in absolute image or normalized coordinates,
         If the coords are in absolute image coordinates, normalize should be set to True and original image size is required.
 
+        The normalization and un-normalization are fused into a single multiply.
+
         Returns
             Un-normalized coordinates in the range of [0, 1] which is expected by the SAM2 model.
         """
-        if normalize:
-            assert orig_hw is not None
-            h, w = orig_hw
-            coords = coords.clone()
-            coords[..., 0] = coords[..., 0] / w
-            coords[..., 1] = coords[..., 1] / h
-
-        coords = coords * self.resolution  # unnormalize coords
-        return coords
+        scale = self.coords_scale(normalize, orig_hw)
+        if scale[0] == scale[1]:
+            return coords * scale[0]
+        return coords * torch.tensor(scale, dtype=coords.dtype, device=coords.device)
 
     def transform_boxes(
         self, boxes: torch.Tensor, normalize=False, orig_hw=None
@@ -75,7 +132,8 @@ class SAM2Transforms(nn.Module):
 
     def postprocess_masks(self, masks: torch.Tensor, orig_hw) -> torch.Tensor:
         """
-        Perform PostProcessing on output masks.
+        Perform PostProcessing on output masks. If orig_hw is None, the masks are
+        only post-processed and not upscaled.
         """
         from sam2.utils.misc import get_connected_components
 
@@ -114,5 +172,7 @@ class SAM2Transforms(nn.Module):
             )
             masks = input_masks
 
+        if orig_hw is None:
+            return masks
         masks = F.interpolate(masks, orig_hw, mode="bilinear", align_corners=False)
         return masks
@@ -0,0 +1,128 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.build_sam import build_sam2
+from sam2.utils.annotation_writer import AnnotationWriter
+from sam2.utils.frame_index import list_frames
+
+
+def load_images(image_dir, image_names):
+    for name in image_names:
+        yield np.array(Image.open(os.path.join(image_dir, name)).convert("RGB"))
+
+
+@torch.inference_mode()
+def generate_masks(mask_generator, image_dir, writer, images_per_batch):
+    """Generate the masks of all images in `image_dir` and stream them to `writer`."""
+    image_names = list_frames(image_dir)
+    images = load_images(image_dir, image_names)
+    all_records = mask_generator.generate_batch(
+        images, images_per_batch=images_per_batch, stream_records=True
+    )
+    for i, (name, records) in enumerate(zip(image_names, all_records)):
+        # generate_batch only reads the images of the next batch once the records
+        # of the previous ones have been consumed, so the size is read from the file
+        with Image.open(os.path.join(image_dir, name)) as image:
+            width, height = image.size
+        image_id = os.path.splitext(name)[0]
+        num_masks = writer.write(
+            image_id, records, height, width, image_info={"file_name": name}
+        )
+        print(f"{i + 1}/{len(image_names)} images, {num_masks} masks for {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the masks of a folder of images with "
+        "SAM2AutomaticMaskGenerator and write them as COCO RLE annotations"
+    )
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--image_dir",
+        type=str,
+        required=True,
+        help="directory containing the images to generate masks for",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="the JSON-lines file to write (or, with --per_image_files, the "
+        "directory to write one JSON file per image to)",
+    )
+    parser.add_argument(
+        "--per_image_files",
+        action="store_true",
+        help="write one JSON file per image instead of a single JSON-lines file",
+    )
+    parser.add_argument(
+        "--points_per_side",
+        type=int,
+        default=32,
+        help="number of points sampled along one side of the image",
+    )
+    parser.add_argument(
+        "--crop_n_layers",
+        type=int,
+        default=0,
+        help="number of layers of image crops to also run mask generation on",
+    )
+    parser.add_argument(
+        "--pred_iou_thresh",
+        type=float,
+        default=0.8,
+        help="filtering threshold on the predicted mask quality",
+    )
+    parser.add_argument(
+        "--stability_score_thresh",
+        type=float,
+        default=0.95,
+        help="filtering threshold on the mask stability score",
+    )
+    parser.add_argument(
+        "--images_per_batch",
+        type=int,
+        default=4,
+        help="number of images processed at once",
+    )
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    mask_generator = SAM2AutomaticMaskGenerator(
+        build_sam2(args.sam2_cfg, args.sam2_checkpoint, device=device),
+        points_per_side=args.points_per_side,
+        crop_n_layers=args.crop_n_layers,
+        pred_iou_thresh=args.pred_iou_thresh,
+        stability_score_thresh=args.stability_score_thresh,
+        # the writer compresses the RLEs itself (pycocotools is optional)
+        output_mode="uncompressed_rle",
+    )
+    layout = "per_image" if args.per_image_files else "jsonl"
+    with AnnotationWriter(args.output, layout=layout) as writer:
+        generate_masks(mask_generator, args.image_dir, writer, args.images_per_batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.utils.frame_index import list_frames
+
+# the suffix of the exported embedding files
+EMBEDDING_SUFFIX = ".sam2emb"
+
+
+@torch.inference_mode()
+def export_embeddings(predictor, image_dir, output_dir, batch_size, dtype):
+    """Embed all images in `image_dir` and export one embedding file per image."""
+    image_names = list_frames(image_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    for start in range(0, len(image_names), batch_size):
+        names = image_names[start : start + batch_size]
+        images = [
+            np.array(Image.open(os.path.join(image_dir, name)).convert("RGB"))
+            for name in names
+        ]
+        predictor.set_image_batch(images)
+        for img_idx, name in enumerate(names):
+            output_path = os.path.join(
+                output_dir, os.path.splitext(name)[0] + EMBEDDING_SUFFIX
+            )
+            predictor.export_image_embedding(
+                output_path, img_idx=img_idx, dtype=dtype, metadata={"image": name}
+            )
+        print(f"{start + len(names)}/{len(image_names)} images embedded")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute the SAM 2 image embeddings of a folder of images"
+    )
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--image_dir",
+        type=str,
+        required=True,
+        help="directory containing the images to embed",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="directory to write the embedding files to",
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="number of images embedded at once"
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="store the embeddings in float32 (instead of float16)",
+    )
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    predictor = SAM2ImagePredictor(
+        build_sam2(args.sam2_cfg, args.sam2_checkpoint, device=device)
+    )
+    export_embeddings(
+        predictor,
+        args.image_dir,
+        args.output_dir,
+        args.batch_size,
+        np.float32 if args.float32 else np.float16,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor, SAM2ImagePredictorOptimized
+
+
+def make_prompts(num_prompts, height, width, seed=0):
+    """Make random point prompts (one click per prompt) and box prompts."""
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0, 1, size=(num_prompts, 1, 2)) * [width, height]
+    labels = np.ones((num_prompts, 1), dtype=np.int32)
+    corners = np.sort(rng.uniform(0, 1, size=(num_prompts, 2, 2)), axis=1)
+    boxes = (corners * [width, height]).reshape(num_prompts, 4)
+    return points.astype(np.float32), labels, boxes.astype(np.float32)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.inference_mode()
+def benchmark(predictor, prompts, warmup, runs):
+    """Return the mean latency of a point and of a box `predict` call."""
+    points, labels, boxes = prompts
+    latencies = []
+    for kwargs in [
+        dict(point_coords=points, point_labels=labels),
+        dict(box=boxes),
+    ]:
+        if len(boxes) == 1:
+            kwargs = {k: v[0] for k, v in kwargs.items()}
+        for _ in range(warmup):
+            predictor.predict(**kwargs, multimask_output=True)
+        synchronize(predictor.device)
+        start = time.time()
+        for _ in range(runs):
+            predictor.predict(**kwargs, multimask_output=True)
+        synchronize(predictor.device)
+        latencies.append((time.time() - start) / runs)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the prompting latency of SAM2ImagePredictor and "
+        "SAM2ImagePredictorOptimized"
+    )
+    parser.add_argument(
+        "--sam2_cfg",
+        type=str,
+        default="configs/sam2.1/sam2.1_hiera_b+.yaml",
+        help="SAM 2 model configuration file",
+    )
+    parser.add_argument(
+        "--sam2_checkpoint",
+        type=str,
+        default="./checkpoints/sam2.1_hiera_base_plus.pt",
+        help="path to the SAM 2 model checkpoint",
+    )
+    parser.add_argument(
+        "--image",
+        type=str,
+        default=None,
+        help="image to prompt (default: a random 1024x1024 image)",
+    )
+    parser.add_argument(
+        "--num_prompts",
+        type=int,
+        nargs="+",
+        default=[1, 3, 16],
+        help="numbers of prompts per predict call to benchmark",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=5,
+        help="number of untimed calls (the first ones compile the decoder)",
+    )
+    parser.add_argument("--runs", type=int, default=50, help="number of timed calls")
+    parser.add_argument(
+        "--no_cuda_graphs",
+        action="store_true",
+        help="only compile the decoder, without capturing it in CUDA graphs",
+    )
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.image is not None:
+        image = np.array(Image.open(args.image).convert("RGB"))
+    else:
+        image = np.random.default_rng(0).integers(0, 256, (1024, 1024, 3), np.uint8)
+    model = build_sam2(args.sam2_cfg, args.sam2_checkpoint, device=device)
+    predictors = {
+        "eager": SAM2ImagePredictor(model),
+        "optimized": SAM2ImagePredictorOptimized(
+            model, use_cuda_graphs=not args.no_cuda_graphs
+        ),
+    }
+    predictors["eager"].set_image(image)
+    features = predictors["eager"]._features
+    predictors["optimized"].set_image_embedding(features, [image.shape[:2]])
+    print(f"benchmarking on {device} with an image of size {image.shape[:2]}")
+
+    for num_prompts in args.num_prompts:
+        prompts = make_prompts(num_prompts, *image.shape[:2])
+        ref_latencies = None
+        for name, predictor in predictors.items():
+            latencies = benchmark(predictor, prompts, args.warmup, args.runs)
+            line = ", ".join(
+                f"{prompt_type} {t * 1000:7.2f} ms"
+                for prompt_type, t in zip(["points", "boxes"], latencies)
+            )
+            if ref_latencies is not None:
+                speedups = [r / t for r, t in zip(ref_latencies, latencies)]
+                line += f" ({speedups[0]:.2f}x, {speedups[1]:.2f}x)"
+            print(f"{num_prompts:3d} prompts, {name:>9}: {line}")
+            ref_latencies = latencies
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from sam2.utils.misc import _frame_to_tensor, FRAME_TRANSFORMS
+
+
+def make_synthetic_lidar_frame(height, width, seed=0):
+    """Make a smooth random RGB frame with horizontal scan-line artifacts."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.uniform(0, 255, size=(height // 32 + 1, width // 32 + 1, 3))
+    img = np.array(
+        Image.fromarray(coarse.astype(np.uint8)).resize((width, height), Image.BICUBIC),
+        dtype=np.float64,
+    )
+    # periodic artifacts at 0.25 cycles/pixel along the vertical axis
+    rows = np.arange(height)[:, None, None]
+    img += 20.0 * np.cos(2 * np.pi * 0.25 * rows)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def benchmark(transform_name, frames, image_size, runs):
+    """Return the mean time per frame and the model-resolution outputs."""
+    frame_transform = FRAME_TRANSFORMS[transform_name]
+    outputs = [_frame_to_tensor(f, image_size, frame_transform) for f in frames]
+    start = time.time()
+    for _ in range(runs):
+        for f in frames:
+            _frame_to_tensor(f, image_size, frame_transform)
+    return (time.time() - start) / (runs * len(frames)), outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the speed and accuracy of the LiDAR artifact filters"
+    )
+    parser.add_argument(
+        "--images",
+        type=str,
+        nargs="*",
+        default=None,
+        help="LiDAR frames to benchmark on (default: synthetic frames)",
+    )
+    parser.add_argument(
+        "--height", type=int, default=2048, help="height of the synthetic frames"
+    )
+    parser.add_argument(
+        "--width", type=int, default=4096, help="width of the synthetic frames"
+    )
+    parser.add_argument(
+        "--image_size", type=int, default=1024, help="model input resolution"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="number of timed runs")
+    args = parser.parse_args()
+
+    if args.images:
+        frames = [np.array(Image.open(p).convert("RGB")) for p in args.images]
+    else:
+        frames = [make_synthetic_lidar_frame(args.height, args.width)]
+    print(f"benchmarking on {len(frames)} frame(s) of size {frames[0].shape[:2]}")
+
+    # the FIR filter at native resolution (`artifact_filter`) is the reference
+    ref_time, ref_outputs = benchmark("lidar", frames, args.image_size, args.runs)
+    print(f"{'lidar':>14}: {ref_time * 1000:8.1f} ms/frame (reference)")
+    for name in ["lidar_fft", "lidar_lowres"]:
+        t, outputs = benchmark(name, frames, args.image_size, args.runs)
+        # errors are measured on the [0, 1] model-resolution frames
+        errors = [(o - r).abs() for o, r in zip(outputs, ref_outputs)]
+        max_err = max(e.max().item() for e in errors)
+        mse = np.mean([(e**2).mean().item() for e in errors])
+        psnr = 10 * np.log10(1.0 / mse) if mse > 0 else float("inf")
+        print(
+            f"{name:>14}: {t * 1000:8.1f} ms/frame ({ref_time / t:5.2f}x), "
+            f"max abs err {max_err:.4f}, PSNR {psnr:.1f} dB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ import numpy as np
 import torch
 from PIL import Image
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.frame_index import list_frame_stems, list_frames
 from tqdm import tqdm
 
 
@@ -130,18 +131,19 @@ def vos_inference(
     score_thresh=0.0,
     use_all_masks=False,
     per_obj_png_file=False,
+    is_lidar=False,
+    use_frame_manifest=False,
 ):
     """Run VOS inference on a single video with the given predictor."""
     # load the video frames and initialize the inference state on this video
+    # (the frame index is cached, so `init_state` below doesn't list the folder again)
     video_dir = os.path.join(base_video_dir, video_name)
-    frame_names = [
-        os.path.splitext(p)[0]
-        for p in os.listdir(video_dir)
-        if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG", '.png']
-    ]
-    frame_names.sort(key=lambda p: os.path.splitext(p)[0])
+    frame_names = list_frame_stems(video_dir, use_manifest=use_frame_manifest)
     inference_state = predictor.init_state(
-        video_path=video_dir, async_loading_frames=False, offload_video_to_cpu=True
+        video_path=video_dir,
+        async_loading_frames=False,
+        offload_video_to_cpu=True,
+        is_lidar=is_lidar,
     )
     height = inference_state["video_height"]
     width = inference_state["video_width"]
@@ -255,9 +257,10 @@ def chunk_files_by_reference(folder_a, folder_b):
     Files are matched by name only (ignoring extensions).
     Each chunk starts from a reference file in B and ends before the next reference.
     """
-    # Get sorted list of files in A and B
-    files_a = sorted(os.listdir(folder_a))
-    files_b = sorted(os.listdir(folder_b))
+    # List the frames of A and B in the same (natural) order and with the same
+    # filtering as the frame loaders (see `list_frames`)
+    files_a = list_frames(folder_a)
+    files_b = list_frames(folder_b)
 
     # Map base name (no extension) of files in A to their index
     index_map = {
@@ -359,12 +362,8 @@ def vos_separate_inference_per_object(
 
     try:
         for subdir in os.listdir(video_dir):
-            frame_names = [
-                os.path.splitext(p)[0]
-                for p in os.listdir(os.path.join(video_dir, subdir))
-                if os.path.splitext(p)[-1] in [".jpg", ".jpeg", ".JPG", ".JPEG", '.png']
-            ]
-            frame_names.sort(key=lambda p: os.path.splitext(p)[0])
+            # (no manifest here, since the chunked subdirectories are only temporary)
+            frame_names = list_frame_stems(os.path.join(video_dir, subdir))
             inference_state = predictor.init_state(
                 video_path=os.path.join(video_dir, subdir), async_loading_frames=False, is_lidar=is_lidar
             )
@@ -564,6 +563,12 @@ def main():
         action="store_true",
         help="whether the input image is a lidar image",
     )
+    parser.add_argument(
+        "--use_frame_manifest",
+        action="store_true",
+        help="whether to persist the frame index of each video folder as a manifest file "
+        "(avoids listing large frame folders again, e.g. on network file systems)",
+    )
     parser.add_argument(
         "--clear_non_cond_mem_around_input",
         action="store_true",
@@ -625,6 +630,8 @@ def main():
                 score_thresh=args.score_thresh,
                 use_all_masks=args.use_all_masks,
                 per_obj_png_file=args.per_obj_png_file,
+                is_lidar=args.is_lidar,
+                use_frame_manifest=args.use_frame_manifest,
             )
         else:
             vos_separate_inference_per_object(